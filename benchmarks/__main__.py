@@ -0,0 +1,145 @@
+## Romman - utility to compare your console ROMs with accuracy-focused datasheets
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module runs benchmarks and outputs their results as json
+
+import argparse
+import json
+import platform
+import tempfile
+import time
+from datetime import datetime, timezone
+from os.path import join
+from romman import data_parsers, database, file_processing
+from benchmarks import generators
+
+def timed(stage:str, results:dict, items:int = None):
+    '''Returns wrapper that runs provided function and saves its wall and cpu
+    time into results[stage]. Items per second are counted from length of
+    function's return value, unless amount of items has been passed explicitly'''
+    def wrapper(function):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        value = function()
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+
+        amount = items if items is not None else len(value)
+        results[stage] = {
+            'wall': round(wall, 6),
+            'cpu': round(cpu, 6),
+            'items': amount,
+            'items_per_second': round(amount / wall, 2) if wall else None,
+            }
+        return value
+    return wrapper
+
+def run(workdir:str, roms:int, rom_size:int, dat_entries:int, mame_entries:int,
+        seed:int = generators.DEFAULT_SEED):
+    '''Generates synthetic data inside workdir and benchmarks each stage on it.
+    Returns dictionary with results'''
+    results = {}
+    synthetic_roms = generators.make_roms(roms, rom_size, seed)
+    known = generators.rom_entries(synthetic_roms)
+    dat_path = join(workdir, 'synthetic.dat')
+    mame_path = join(workdir, 'synthetic.xml')
+    tree_path = join(workdir, 'roms')
+    generators.write_dat(dat_path, known + generators.make_fake_entries(dat_entries, seed))
+    generators.write_mame_xml(mame_path, generators.make_fake_entries(mame_entries, seed + 1))
+    generators.write_rom_tree(tree_path, synthetic_roms)
+    del synthetic_roms
+
+    files = timed('walk', results)(lambda: file_processing.get_files(tree_path))
+
+    hashed = []
+    def hash_files():
+        for path in files:
+            hashed.extend(file_processing.file_processor(path))
+        return hashed
+    timed('hash', results)(hash_files)
+    #files have just been written, so these are read from page cache - thus
+    #this measures hashing itself, not the disk. Only content of normal files is
+    #actually hashed - archives only have their headers read, thus their content
+    #is counted separately and doesnt affect throughput
+    hashed_bytes = sum(item['size'] for item in hashed if not item['is_archive'])
+    results['hash']['hashed_bytes'] = hashed_bytes
+    results['hash']['archived_bytes'] = sum(item['size'] or 0 for item in hashed
+                                            if item['is_archive'])
+    results['hash']['mb_per_second'] = round(
+        hashed_bytes / (1024 * 1024) / results['hash']['wall'], 2)
+
+    dat = timed('parse_dat', results)(lambda: data_parsers.dat_file(dat_path))
+    mame = timed('parse_mame', results)(lambda: data_parsers.mame_xml(mame_path))
+    db = timed('build_database', results, len(dat) + len(mame))(
+                                    lambda: database.Database(dat + mame))
+    del dat, mame
+
+    def match():
+        return [item for item in hashed if db.find(item['crc'], size=item.get('size'))]
+    matched = timed('match', results, len(hashed))(match)
+    results['match']['matches'] = len(matched)
+    return results
+
+def main():
+    ap = argparse.ArgumentParser(prog='python3 -m benchmarks', description=(
+        "Benchmark romman's stages on synthetic datasheets and ROM trees. Runs "
+        "entirely offline and prints results as json"))
+    ap.add_argument("--roms", help="Amount of ROMs to generate", type=int, default=2000)
+    ap.add_argument("--rom-size", help="Size of each ROM, in bytes", type=int,
+                    default=64 * 1024)
+    ap.add_argument("--dat-entries", help=(
+        "Amount of non-matching entries to add to DAT, on top of generated ROMs"
+        ), type=int, default=50000)
+    ap.add_argument("--mame-entries", help="Amount of entries in MAME xml", type=int,
+                    default=200000)
+    ap.add_argument("--seed", help="Seed of generated data", type=int,
+                    default=generators.DEFAULT_SEED)
+    ap.add_argument("--workdir", help=(
+        "Directory to generate data in. Defaults to temporary directory, which is "
+        "removed afterwards"), type=str)
+    ap.add_argument("--output", help="Save results into this file instead of printing",
+                    type=str)
+    args = ap.parse_args()
+
+    options = {
+        'roms': args.roms,
+        'rom_size': args.rom_size,
+        'dat_entries': args.dat_entries,
+        'mame_entries': args.mame_entries,
+        'seed': args.seed,
+        }
+    if args.workdir:
+        stages = run(args.workdir, **options)
+    else:
+        with tempfile.TemporaryDirectory(prefix='romman-bench-') as workdir:
+            stages = run(workdir, **options)
+
+    report = {
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': options,
+        'stages': stages,
+        }
+    text = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+## Romman - utility to compare your console ROMs with accuracy-focused datasheets
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module contains generators of synthetic datasheets and ROM trees
+
+import random
+import zipfile
+import py7zr
+from hashlib import md5, sha1
+from os import makedirs
+from os.path import join
+from zlib import crc32
+from xml.sax.saxutils import quoteattr
+
+DEFAULT_SEED = 0
+
+class SyntheticRom:
+    '''Content of generated ROM, with its hash sums'''
+    __slots__ = ('name', 'data', 'size', 'crc', 'md5', 'sha1')
+
+    def __init__(self, name:str, data:bytes):
+        self.name = name
+        self.data = data
+        self.size = len(data)
+        self.crc = f"{crc32(data):08X}"
+        self.md5 = md5(data).hexdigest()
+        self.sha1 = sha1(data).hexdigest()
+
+def make_roms(amount:int, size:int, seed:int = DEFAULT_SEED, prefix:str = 'rom'):
+    '''Returns list of provided amount of SyntheticRom with random content of
+    provided size. Same seed always produces the same roms'''
+    rng = random.Random(seed)
+    #only a small chunk is random, to not spend ages generating large roms
+    random_size = min(size, 4096)
+    return [SyntheticRom(f"{prefix}{i:06d}.bin",
+                         rng.getrandbits(random_size * 8).to_bytes(random_size, 'little')
+                            .ljust(size, b'\0'))
+            for i in range(amount)]
+
+def make_fake_entries(amount:int, seed:int = DEFAULT_SEED):
+    '''Returns list of (name, size, crc, md5, sha1) tuples for entries that
+    dont match any generated rom, used to inflate datasheets to desired scale'''
+    rng = random.Random(seed + 1)
+    return [(f"missing{i:08d}.bin", rng.randrange(1024, 16 * 1024 * 1024),
+             f"{rng.getrandbits(32):08X}", f"{rng.getrandbits(128):032x}",
+             f"{rng.getrandbits(160):040x}")
+            for i in range(amount)]
+
+def rom_entries(roms:list):
+    return [(rom.name, rom.size, rom.crc, rom.md5, rom.sha1) for rom in roms]
+
+def rom_element(name:str, size:int, crc:str, md5sum:str, sha1sum:str):
+    return (f'<rom name={quoteattr(name)} size="{size}" crc="{crc}" '
+            f'md5="{md5sum}" sha1="{sha1sum}"/>')
+
+def write_dat(path:str, entries:list, group:str = 'Synthetic - Console',
+              category:str = 'No-Intro'):
+    '''Writes Logiqx DAT with one game per provided entry (see make_fake_entries)'''
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0"?>\n<datafile>\n')
+        f.write(f'\t<header>\n\t\t<name>{group}</name>\n'
+                f'\t\t<homepage>{category}</homepage>\n\t</header>\n')
+        for entry in entries:
+            name = entry[0]
+            f.write(f'\t<game name={quoteattr(name)}>\n'
+                    f'\t\t<description>{name}</description>\n'
+                    f'\t\t{rom_element(*entry)}\n\t</game>\n')
+        f.write('</datafile>\n')
+
+def write_mame_xml(path:str, entries:list, roms_per_machine:int = 8):
+    '''Writes MAME-style xml, with provided entries grouped into machines'''
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0"?>\n<mame build="synthetic">\n')
+        for i in range(0, len(entries), roms_per_machine):
+            f.write(f'\t<machine name="machine{i // roms_per_machine:06d}">\n'
+                    '\t\t<description>Synthetic machine</description>\n')
+            for entry in entries[i:i + roms_per_machine]:
+                f.write(f'\t\t{rom_element(*entry)}\n')
+            f.write('\t</machine>\n')
+        f.write('</mame>\n')
+
+def write_rom_tree(directory:str, roms:list, zip_share:float = 0.25,
+                   sevenzip_share:float = 0.1, roms_per_archive:int = 4,
+                   files_per_directory:int = 100):
+    '''Spreads provided roms over subdirectories of provided directory, as loose
+    files, zip and 7z archives (in provided shares). Returns amount of created
+    files'''
+    zips = int(len(roms) * zip_share)
+    sevenzips = int(len(roms) * sevenzip_share)
+    groups = []
+    archived = roms[:zips + sevenzips]
+    for i in range(0, len(archived), roms_per_archive):
+        kind = 'zip' if i < zips else '7z'
+        groups.append((kind, archived[i:i + roms_per_archive]))
+    groups.extend(('file', [rom]) for rom in roms[zips + sevenzips:])
+
+    for i, (kind, content) in enumerate(groups):
+        subdirectory = join(directory, f"dir{i // files_per_directory:04d}")
+        makedirs(subdirectory, exist_ok=True)
+        if kind == 'file':
+            with open(join(subdirectory, content[0].name), 'wb') as f:
+                f.write(content[0].data)
+        elif kind == 'zip':
+            with zipfile.ZipFile(join(subdirectory, f"pack{i:06d}.zip"), 'w',
+                                 zipfile.ZIP_DEFLATED) as zf:
+                for rom in content:
+                    zf.writestr(rom.name, rom.data)
+        else:
+            with py7zr.SevenZipFile(join(subdirectory, f"pack{i:06d}.7z"), 'w') as zf:
+                for rom in content:
+                    zf.writestr(rom.data, rom.name)
+
+    return len(groups)
@@ -0,0 +1,113 @@
+## Romman - utility to compare your console ROMs with accuracy-focused datasheets
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module checks how long it takes romman-cli to import its modules, and that
+# heavy dependencies arent imported when they arent needed. Exits with non-zero
+# code on regression. Usage: python3 -m benchmarks.importtime -h
+
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+from os.path import join, dirname, abspath
+from benchmarks import generators
+
+LAUNCHER_PATH = join(dirname(dirname(abspath(__file__))), 'romman-cli')
+#modules that should only be imported if they are actually used
+HEAVY_MODULES = ('requests', 'lxml', 'py7zr', 'multiprocessing')
+
+def get_imports(arguments:list, cwd:str = None):
+    '''Runs python with -X importtime and provided arguments. Returns dictionary
+    with names of imported modules as keys and their own import time (in
+    microseconds) as values'''
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + arguments,
+                            cwd=cwd, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True)
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        if not self_time.strip().isdigit():
+            #header of the table
+            continue
+        imports[name.strip()] = int(self_time)
+    return imports
+
+def measure(arguments:list, cwd:str = None, baseline:dict = None):
+    '''Returns dictionary with import time of modules, imported by running
+    python with provided arguments (but not by bare interpreter) and list of
+    heavy modules among these'''
+    imports = get_imports(arguments, cwd)
+    baseline = baseline if baseline is not None else get_imports(['-c', 'pass'])
+    own_imports = {name: value for name, value in imports.items()
+                   if name not in baseline}
+    return {
+        'modules': len(own_imports),
+        'import_ms': round(sum(own_imports.values()) / 1000, 2),
+        'heavy_modules': sorted({name.split('.')[0] for name in own_imports
+                                 if name.split('.')[0] in HEAVY_MODULES}),
+        }
+
+def run():
+    '''Measures imports of cli in scenarios that shouldnt need heavy modules.
+    Returns dictionary with results of each'''
+    baseline = get_imports(['-c', 'pass'])
+    results = {
+        'help': measure([LAUNCHER_PATH, '--help'], baseline=baseline),
+        }
+
+    #run over single rom, with datasheet that has already been compiled on
+    #previous run - thus no parsing is needed
+    with tempfile.TemporaryDirectory(prefix='romman-importtime-') as workdir:
+        roms = generators.make_roms(1, 1024)
+        generators.write_dat(join(workdir, 'synthetic.dat'), generators.rom_entries(roms))
+        with open(join(workdir, roms[0].name), 'wb') as f:
+            f.write(roms[0].data)
+        arguments = [LAUNCHER_PATH, roms[0].name, '--datfiles', 'synthetic.dat']
+        subprocess.run([sys.executable] + arguments, cwd=workdir,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        results['cached_single_file'] = measure(arguments, workdir, baseline)
+
+    return results
+
+def main():
+    ap = argparse.ArgumentParser(prog='python3 -m benchmarks.importtime', description=(
+        "Check import time of romman-cli. Fails if modules that arent needed "
+        f"({', '.join(HEAVY_MODULES)}) get imported, or if imports take too long"))
+    ap.add_argument("--max-ms", help=(
+        "Fail if imports of any scenario take longer than that many milliseconds"
+        ), type=float)
+    args = ap.parse_args()
+
+    results = run()
+    print(json.dumps(results, indent=4))
+
+    failed = False
+    for scenario, result in results.items():
+        if result['heavy_modules']:
+            print(f"{scenario}: imported {', '.join(result['heavy_modules'])}",
+                  file=sys.stderr)
+            failed = True
+        if args.max_ms is not None and result['import_ms'] > args.max_ms:
+            print(f"{scenario}: imports took {result['import_ms']}ms, which is "
+                  f"more than {args.max_ms}ms", file=sys.stderr)
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -14,12 +14,42 @@
 ## You should have received a copy of the GNU General Public License
 ## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
 
-from .hashcheck import *
-from .data_parsers import *
-from .file_processing import *
-from .dat_updater import *
-from .configuration import *
-
+import importlib
 import logging
 
+#subsystems are imported on first access (say, romman.file_processing), coz some
+#of them take a while to import and cli is often ran to verify just a few files
+SUBMODULES = (
+    'hashcheck',
+    'data_parsers',
+    'file_processing',
+    'io_scheduler',
+    'sevenzip',
+    'bloom',
+    'datasheet_cache',
+    'hash_cache',
+    'pipeline',
+    'metrics',
+    'dat_updater',
+    'daemon',
+    'report',
+    'database',
+    'configuration',
+    )
+
+def __getattr__(name:str):
+    if name in SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    #contents of submodules used to be re-exported by package itself, so these
+    #are still accessible that way, albeit at cost of importing everything
+    if not name.startswith('_'):
+        for submodule in SUBMODULES:
+            module = importlib.import_module(f".{submodule}", __name__)
+            if hasattr(module, name):
+                return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(set(globals()) | set(SUBMODULES))
+
 logging.getLogger(__name__).addHandler(logging.NullHandler())
@@ -0,0 +1,74 @@
+## Romman - utility to compare your console ROMs with accuracy-focused datasheets
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module contains bloom filter, used to summarize content of datasheets
+
+from math import ceil, log as ln
+
+MASK_64 = 0xffffffffffffffff
+#its error rate of each filter, and there may be hundreds of datasheets, each
+#with its own. Thus it has to be tiny, else nearly every crc would seem to be
+#part of some datasheet. Costs about 29 bits per value
+DEFAULT_ERROR_RATE = 1e-6
+
+def mix(value:int):
+    '''Scrambles bits of provided int (say, crc or size), so close values end up
+    far from each other. Unlike hash(), its the same in every process'''
+    value &= MASK_64
+    value = ((value ^ (value >> 33)) * 0xff51afd7ed558ccd) & MASK_64
+    value = ((value ^ (value >> 33)) * 0xc4ceb9fe1a85ec53) & MASK_64
+    return value ^ (value >> 33)
+
+class BloomFilter:
+    '''Compact set of ints, which may give false positives (with provided
+    error_rate), but never false negatives'''
+    def __init__(self, capacity:int, error_rate:float = DEFAULT_ERROR_RATE):
+        capacity = max(capacity, 1)
+        bits_amount = ceil(-capacity * ln(error_rate) / (ln(2) ** 2))
+        self.bits_amount = max(bits_amount, 8)
+        self.hashes_amount = max(round(self.bits_amount / capacity * ln(2)), 1)
+        self.bits = bytearray(ceil(self.bits_amount / 8))
+
+    def positions(self, value:int):
+        hashed = mix(value)
+        first = hashed & 0xffffffff
+        #must be odd, to not end up checking the same bit over and over
+        second = (hashed >> 32) | 1
+        for i in range(self.hashes_amount):
+            yield (first + i * second) % self.bits_amount
+
+    def add(self, value:int):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def __contains__(self, value:int):
+        for position in self.positions(value):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+class BloomSizes:
+    '''Container of sizes from multiple bloom filters, usable as known_sizes of
+    file_processing.process_files'''
+    def __init__(self, filters:list):
+        self.filters = filters
+
+    def __contains__(self, size:int):
+        return any(size in bloom for bloom in self.filters)
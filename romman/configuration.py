@@ -21,6 +21,8 @@ TOOL_NAME = "romman"
 PROGRAM_DIRECTORY = '.' #to be replaced with other stuff later
 CACHE_DIRECTORY = join(PROGRAM_DIRECTORY, 'Cache')
 DEFAULT_DATASHEETS_DIRECTORY = join(PROGRAM_DIRECTORY, "Datasheets")
+DEFAULT_SOCKET_PATH = join(CACHE_DIRECTORY, 'romman.sock')
+DEFAULT_POLL_INTERVAL = 30
 
 NOINTRO_PREFIX = "nointro"
 REDUMP_PREFIX = "redump"
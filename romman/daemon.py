@@ -0,0 +1,322 @@
+## Romman - utility to compare your console ROMs with accuracy-focused datasheets
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module contains daemon, that keeps database in memory, verifies new or
+# changed files in watched directories and answers queries over unix socket
+
+import json
+import logging
+import socket
+import socketserver
+from os import stat, remove, makedirs
+from os.path import dirname
+from threading import Event, Lock, Thread
+from time import time
+from romman import (configuration, database, datasheet_cache, dat_updater,
+                    file_processing, hash_cache, report)
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = configuration.DEFAULT_SOCKET_PATH
+DEFAULT_POLL_INTERVAL = configuration.DEFAULT_POLL_INTERVAL
+
+def get_stamps(paths:list):
+    '''Returns tuple that changes each time datasheets on provided paths do. For
+    default datasheets directory, only updater's stamp is checked (see
+    dat_updater.mark_updated), for others - modification times of all files'''
+    stamps = []
+    for path in paths:
+        if path == configuration.DEFAULT_DATASHEETS_DIRECTORY:
+            path = dat_updater.UPDATE_STAMP_PATH
+        try:
+            files = file_processing.get_files(path, exclude=datasheet_cache.SERVICE_FILES)
+        except Exception:
+            #say, directory or stamp doesnt exist yet
+            stamps.append(None)
+            continue
+        for f in files:
+            try:
+                stamps.append((f, stat(f).st_mtime_ns))
+            except OSError:
+                stamps.append((f, None))
+    return tuple(stamps)
+
+def scan_files(directories:list, include:list = None, exclude:list = None):
+    '''Returns dictionary with paths of files inside provided directories as keys
+    and (size, mtime) as values'''
+    files = {}
+    for directory in directories:
+        try:
+            for path in file_processing.walk_files(directory, include, exclude):
+                try:
+                    st = stat(path)
+                except OSError:
+                    continue
+                files[path] = (st.st_size, st.st_mtime_ns)
+        except Exception as e:
+            log.warning(f"Couldnt get files from {directory}: {e}. Skipping")
+    return files
+
+class Daemon:
+    '''Keeps database of provided datasheets in memory, periodically checks
+    provided directories for new or changed files and verifies them. Answers
+    queries sent as json lines to unix socket (see handle for commands)'''
+    def __init__(self, datasheets:list, directories:list,
+                 socket_path:str = DEFAULT_SOCKET_PATH,
+                 poll_interval:float = DEFAULT_POLL_INTERVAL, jobs:int = 1,
+                 executor:str = 'process', digests:tuple = ('crc',),
+                 include:list = None, exclude:list = None, max_memory:int = None,
+                 deep_archives:bool = False):
+        self.datasheets = datasheets
+        self.directories = directories
+        self.socket_path = socket_path
+        self.poll_interval = poll_interval
+        self.jobs = jobs
+        self.executor = executor
+        self.digests = digests
+        self.include = include
+        self.exclude = exclude
+        self.max_memory = max_memory
+        self.deep_archives = deep_archives
+
+        #guards database and results, which are replaced or changed by main
+        #thread while queries run in others
+        self.lock = Lock()
+        self.database = None
+        self.stamps = None
+        self.loaded_at = None
+        self.checked_at = None
+        #path: (size, mtime) of files that have been verified
+        self.files = {}
+        #path: json-friendly result of its verification
+        self.results = {}
+        self.hash_cache = hash_cache.HashCache()
+        self.reload_requested = Event()
+        self.stopped = Event()
+        #set to check watched directories without waiting for poll_interval
+        self.wake = Event()
+        self.server = None
+
+    def load(self):
+        '''Loads datasheets into new database and replaces current one with it'''
+        log.info("Loading the database (may take a while)")
+        self.stamps = get_stamps(self.datasheets)
+        new_database = database.Database(max_memory = self.max_memory)
+        datafiles = datasheet_cache.find_datasheets(self.datasheets)
+        for item, data, error in datasheet_cache.load_datasheets(datafiles, self.jobs):
+            if error:
+                log.warning(f"Couldnt process data file {item}: {error}")
+                continue
+            new_database.merge(data)
+
+        with self.lock:
+            old_database, self.database = self.database, new_database
+            self.loaded_at = time()
+            #results of already verified files may be different now
+            self.results = {}
+        self.files = {}
+        if old_database is not None:
+            old_database.close()
+        log.info(f"Loaded {len(new_database)} entries from {len(datafiles)} datasheets")
+
+    def find(self, crc, size:int = None, md5:str = None, sha1:str = None,
+             sha256:str = None):
+        '''Returns list of json-friendly dictionaries of matching entries'''
+        with self.lock:
+            entries = self.database.find(crc, size=size, md5=md5, sha1=sha1,
+                                         sha256=sha256)
+        return [entry.as_dict() for entry in entries]
+
+    def verify(self, paths:list):
+        '''Verifies provided files, reports and saves results'''
+        with self.lock:
+            known_sizes = self.database.sizes
+        processed_files = file_processing.process_files(
+                                                    paths,
+                                                    self.digests,
+                                                    jobs = self.jobs,
+                                                    executor = self.executor,
+                                                    cache = self.hash_cache,
+                                                    known_sizes = known_sizes,
+                                                    deep_archives = self.deep_archives,
+                                                    )
+        #results are logged the same way as by cli
+        reporter = report.Reporter()
+        for path, data, error in processed_files:
+            if error or not data:
+                reporter.add_error(path, error)
+                with self.lock:
+                    self.results[path] = {'path': path,
+                                          'error': str(error) if error else None,
+                                          'items': []}
+                continue
+
+            items = []
+            for item in data:
+                with self.lock:
+                    entries = self.database.find(item['crc'], size=item.get('size'),
+                                                 md5=item.get('md5'), sha1=item.get('sha1'),
+                                                 sha256=item.get('sha256'))
+                reporter.add_item(item, entries)
+                items.append({
+                    'name': item['name'],
+                    'path': item['path'],
+                    'crc': item['crc'],
+                    'size': item.get('size'),
+                    'is_archive': item['is_archive'],
+                    'matches': [entry.as_dict() for entry in entries],
+                    })
+            with self.lock:
+                self.results[path] = {'path': path, 'error': None, 'items': items}
+        log.info(f"Got {len(reporter.matched)} matching files, {reporter.misses} "
+                 f"non-matching and was unable to process {reporter.errors} files")
+
+        try:
+            self.hash_cache.flush()
+        except Exception as e:
+            log.warning(f"Couldnt save hash cache: {e}")
+
+    def poll(self):
+        '''Reloads database if datasheets have been updated, then verifies new
+        and changed files in watched directories'''
+        if self.reload_requested.is_set() or get_stamps(self.datasheets) != self.stamps:
+            self.reload_requested.clear()
+            self.load()
+
+        files = scan_files(self.directories, self.include, self.exclude)
+        changed = [path for path, key in files.items() if self.files.get(path) != key]
+        with self.lock:
+            for path in self.files.keys() - files.keys():
+                self.results.pop(path, None)
+        if changed:
+            log.info(f"Verifying {len(changed)} new or changed files")
+            self.verify(changed)
+        self.files = files
+        self.checked_at = time()
+
+    def status(self):
+        with self.lock:
+            entries_amount = len(self.database)
+            matched_files = sum(1 for result in self.results.values()
+                                if any(item['matches'] for item in result['items']))
+        return {
+            'entries': entries_amount,
+            'watched_files': len(self.files),
+            'matched_files': matched_files,
+            'loaded_at': self.loaded_at,
+            'checked_at': self.checked_at,
+            }
+
+    def handle(self, request:dict):
+        '''Returns response to provided request. Supported commands:
+        - find: "items" is list of dictionaries with crc and, optionally, size,
+        md5, sha1 and sha256. Returns "matches" - list of matching entries for each
+        - results: returns "results" of verification of watched files. If "paths"
+        have been provided - only of these
+        - status: returns info about database and watched files
+        - reload: reloads datasheets before next check of watched files'''
+        command = request.get('command')
+        if command == 'find':
+            matches = []
+            for item in request.get('items', []):
+                matches.append(self.find(item.get('crc'), size=item.get('size'),
+                                         md5=item.get('md5'), sha1=item.get('sha1'),
+                                         sha256=item.get('sha256')))
+            return {'matches': matches}
+        if command == 'results':
+            with self.lock:
+                results = dict(self.results)
+            paths = request.get('paths')
+            if paths is not None:
+                return {'results': [results.get(path) for path in paths]}
+            return {'results': list(results.values())}
+        if command == 'status':
+            return self.status()
+        if command == 'reload':
+            self.reload_requested.set()
+            self.wake.set()
+            return {'reload': True}
+        raise ValueError(f"Unknown command: {command}")
+
+    def start_server(self):
+        makedirs(dirname(self.socket_path) or '.', exist_ok=True)
+        #leftover of daemon that has crashed
+        try:
+            remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, RequestHandler)
+        self.server.daemon_threads = True
+        self.server.owner = self
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        log.info(f"Listening on {self.socket_path}")
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+
+    def run(self):
+        '''Loads database and runs till stop is called'''
+        self.hash_cache.load()
+        self.load()
+        self.start_server()
+        try:
+            while not self.stopped.is_set():
+                try:
+                    self.poll()
+                except Exception as e:
+                    log.warning(f"Couldnt check watched directories: {e}")
+                self.wake.wait(self.poll_interval)
+                self.wake.clear()
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            try:
+                remove(self.socket_path)
+            except FileNotFoundError:
+                pass
+            with self.lock:
+                self.database.close()
+            try:
+                self.hash_cache.flush()
+            except Exception as e:
+                log.warning(f"Couldnt save hash cache: {e}")
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    '''Reads json requests (one per line) and writes json responses to them'''
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.owner.handle(json.loads(line))
+            except Exception as e:
+                response = {'error': str(e)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+def query(request:dict, socket_path:str = DEFAULT_SOCKET_PATH):
+    '''Sends provided request to running daemon and returns its response'''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile('rwb') as f:
+            f.write(json.dumps(request).encode('utf-8') + b'\n')
+            f.flush()
+            response = json.loads(f.readline())
+    if 'error' in response:
+        raise ValueError(response['error'])
+    return response
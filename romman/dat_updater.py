@@ -17,17 +17,32 @@
 # This module contains functions related to updating datasheets to their newest versions
 
 import logging
-import requests
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from errno import EINVAL, ENOSYS, EOPNOTSUPP
 from re import findall
-from time import sleep
-from os import remove
-from os.path import join
-from romman import file_processing, configuration
+from threading import Lock, Semaphore
+from time import monotonic, sleep, time
+from os import makedirs, replace, rename, link, stat, fsencode, strerror
+from os.path import join, isfile, isdir, isabs, basename, dirname, normpath, relpath
+from shutil import copyfileobj, copy2, rmtree
+from zipfile import ZipFile
+from urllib.parse import urlsplit
+from romman import file_processing, configuration, datasheet_cache, hashcheck
 log = logging.getLogger(__name__)
 
 CACHE_DIRECTORY = configuration.CACHE_DIRECTORY
 DEFAULT_DATASHEETS_DIRECTORY = configuration.DEFAULT_DATASHEETS_DIRECTORY
 DATASHEETS_DOWNLOAD_DIRECTORY = join(CACHE_DIRECTORY, 'Downloads')
+#ETag and Last-Modified of downloaded archives, to avoid downloading these again
+#if they didnt change
+DOWNLOADS_METADATA_PATH = join(DATASHEETS_DOWNLOAD_DIRECTORY, 'metadata.json')
+#crc and size of each extracted datasheet, kept next to them
+MANIFEST_NAME = '.manifest.json'
+#touched each time some datasheets have been changed, so running daemon knows
+#its time to reload them
+UPDATE_STAMP_PATH = join(DEFAULT_DATASHEETS_DIRECTORY, '.last_update')
 
 NOINTRO_PREFIX = configuration.NOINTRO_PREFIX
 REDUMP_PREFIX = configuration.REDUMP_PREFIX
@@ -38,107 +53,231 @@ NOINTRO_URL = 'https://datomatic.no-intro.org'
 TOSEC_URL = 'https://www.tosecdev.org'
 REDUMP_URL = 'http://redump.org' #yep, is http coz redump has no https version
 MAME_URL = 'https://www.mamedev.org'
-SESSION = requests.Session()
-SESSION.timeout = 100
+#created on first request, coz importing requests takes a while and most runs
+#dont download anything
+SESSION = None
+SESSION_LOCK = Lock()
+TIMEOUT = 100
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+#to avoid getting banned for loads of requests - limiting amount of simultaneous
+#requests to the same host, as well as how often these can be started
+HOST_CONCURRENCY = 2
+HOST_REQUEST_INTERVAL = 1
 
 log = logging.getLogger(__name__)
 
+class HostLimiter:
+    '''Limits amount of simultaneous requests to each host and minimal interval
+    between starting these'''
+    def __init__(self, concurrency:int = HOST_CONCURRENCY,
+                 interval:float = HOST_REQUEST_INTERVAL):
+        self.concurrency = concurrency
+        self.interval = interval
+        self.lock = Lock()
+        self.semaphores = {}
+        self.next_request_time = {}
+
+    def acquire(self, url:str):
+        host = urlsplit(url).netloc
+        with self.lock:
+            semaphore = self.semaphores.setdefault(host, Semaphore(self.concurrency))
+        semaphore.acquire()
+
+        with self.lock:
+            now = monotonic()
+            start_time = max(now, self.next_request_time.get(host, now))
+            self.next_request_time[host] = start_time + self.interval
+        if start_time > now:
+            sleep(start_time - now)
+
+    def release(self, url:str):
+        self.semaphores[urlsplit(url).netloc].release()
+
+LIMITER = HostLimiter()
+METADATA_LOCK = Lock()
+
+def get_session():
+    '''Returns SESSION, creating it if necessary'''
+    global SESSION
+    with SESSION_LOCK:
+        if SESSION is None:
+            import requests
+            SESSION = requests.Session()
+    return SESSION
+
+def request(method:str, url:str, **kwargs):
+    '''Sends request via SESSION, respecting per-host limits. For responses
+    which content should be streamed, use stream_request instead'''
+    with stream_request(method, url, **kwargs) as response:
+        #reading content while slot of host is still taken
+        response.content
+    return response
+
+@contextmanager
+def stream_request(method:str, url:str, **kwargs):
+    '''Sends request via SESSION and yields its response, without consuming its
+    content. Slot of host in LIMITER is held until the end of with block, so
+    content streamed inside it counts towards per-host limits too'''
+    LIMITER.acquire(url)
+    try:
+        with get_session().request(method, url, timeout=TIMEOUT, stream=True,
+                                   **kwargs) as response:
+            response.raise_for_status()
+            yield response
+    finally:
+        LIMITER.release(url)
+
+def load_metadata():
+    try:
+        with open(DOWNLOADS_METADATA_PATH, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        log.warning(f"Unable to read {DOWNLOADS_METADATA_PATH}: {e}. Ignoring")
+        return {}
+
+def update_metadata(save_path:str, data:dict):
+    with METADATA_LOCK:
+        metadata = load_metadata()
+        metadata[save_path] = data
+        makedirs(DATASHEETS_DOWNLOAD_DIRECTORY, exist_ok=True)
+        temp_path = f"{DOWNLOADS_METADATA_PATH}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(metadata, f, indent=4)
+        replace(temp_path, DOWNLOADS_METADATA_PATH)
+
+def download_file(url:str, filename:str, filedir:str, method:str = 'get', **kwargs):
+    '''Downloads file from provided url and streams it to filedir/filename.
+    If that file has already been downloaded before - asks server to only send it
+    if it has changed since. Returns True if file has been downloaded and False
+    if it didnt change'''
+    save_path = join(filedir, filename)
+    headers = dict(kwargs.pop('headers', {}))
+    if isfile(save_path):
+        with METADATA_LOCK:
+            known = load_metadata().get(save_path, {})
+        if known.get('etag'):
+            headers['If-None-Match'] = known['etag']
+        if known.get('last_modified'):
+            headers['If-Modified-Since'] = known['last_modified']
+
+    log.debug(f"Trying to fetch {url} (may take a while)")
+    with stream_request(method, url, headers=headers, **kwargs) as response:
+        if response.status_code == 304:
+            log.debug(f"{save_path} didnt change since last download")
+            return False
+
+        file_processing.save_stream(response.iter_content(DOWNLOAD_CHUNK_SIZE),
+                                    filename = filename,
+                                    filedir = filedir)
+
+    update_metadata(save_path, {
+        'url': url,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        })
+    return True
+
 def get_nointro():
     '''Downloads daily nointro dat pack in zip.
-    Saves into DATASHEETS_DOWNLOAD_DIRECTORY/NOINTRO_PREFIX'''
+    Saves into DATASHEETS_DOWNLOAD_DIRECTORY/NOINTRO_PREFIX.
+    Returns True if anything has been downloaded'''
     url = f'{NOINTRO_URL}/index.php?page=download&op=daily&s=64'
     log.debug(f"Attempting to download latest nointro datasheets from {url}")
-    get_download_link = SESSION.post(url,
-                                     headers={'referer': url},
-                                     data={
-                                           'dat_type': 'standard',
-                                           'daily_download': 'Prepare',
-                                           'recaptcha_response': "",
-                                           },
-                                    )
+    get_download_link = request('post', url,
+                                headers={'referer': url},
+                                data={
+                                      'dat_type': 'standard',
+                                      'daily_download': 'Prepare',
+                                      'recaptcha_response': "",
+                                      },
+                               )
     download_link = get_download_link.url
-    log.debug(f"Got download link: {download_link}. "
-               "Trying to fetch archive (may take a while)")
-    datasheet_archive = SESSION.post(download_link,
-                                     headers={'referer': download_link},
-                                     data={
-                                            'wtwtwtf': 'Download',
-                                            'what_im_doing_here': "",
-                                            },
-                                    )
-    log.debug(f"Successfully retrieved datasheets archive, attempting to save")
+    log.debug(f"Got download link: {download_link}")
     download_directory = join(DATASHEETS_DOWNLOAD_DIRECTORY, NOINTRO_PREFIX)
-    file_processing.save_file(data = datasheet_archive.content,
-                              filename = 'nointro.zip',
-                              filedir = download_directory)
+    return download_file(download_link,
+                         filename = 'nointro.zip',
+                         filedir = download_directory,
+                         method = 'post',
+                         headers = {'referer': download_link},
+                         data = {
+                                 'wtwtwtf': 'Download',
+                                 'what_im_doing_here': "",
+                                 },
+                        )
 
 def get_tosec():
     '''Downloads latest available tosec dat pack in zip.
-    Saves into DATASHEETS_DOWNLOAD_DIRECTORY/TOSEC_PREFIX'''
+    Saves into DATASHEETS_DOWNLOAD_DIRECTORY/TOSEC_PREFIX.
+    Returns True if anything has been downloaded'''
     url = f'{TOSEC_URL}/downloads'
     log.debug(f"Attempting to download latest tosec datasheets from {url}")
-    get_downloads = SESSION.get(url)
+    get_downloads = request('get', url)
     dpu = findall('<div class="pd-subcategory"><a href="(.*)">', get_downloads.text)
     download_page_url = f"{TOSEC_URL}{dpu[0]}"
     log.debug(f"Got downloads page url: {download_page_url} fetching")
-    download_page = SESSION.get(download_page_url)
+    download_page = request('get', download_page_url)
     dps = findall('<a class="" href="(.*?)"', download_page.text)
     download_link = f"{TOSEC_URL}{dps[0]}"
-    log.debug(f"Got downloads link: {download_link}. "
-               "Trying to fetch archive (may take a while)")
-    datasheet_archive = SESSION.get(download_link)
-    log.debug(f"Successfully retrieved datasheets archive, attempting to save")
+    log.debug(f"Got downloads link: {download_link}")
     download_directory = join(DATASHEETS_DOWNLOAD_DIRECTORY, TOSEC_PREFIX)
-    file_processing.save_file(data = datasheet_archive.content,
-                              filename = 'tosec.zip',
-                              filedir = download_directory)
+    return download_file(download_link,
+                         filename = 'tosec.zip',
+                         filedir = download_directory)
 
 def get_redump():
     '''Downloads latest available redump dat packs in zip.
-    Saves into DATASHEETS_DOWNLOAD_DIRECTORY/REDUMP_PREFIX'''
+    Saves into DATASHEETS_DOWNLOAD_DIRECTORY/REDUMP_PREFIX.
+    Returns True if anything has been downloaded'''
     url = f'{REDUMP_URL}/downloads'
     log.debug(f"Attempting to download latest redump datasheets from {url}")
-    get_downloads = SESSION.get(url)
+    get_downloads = request('get', url)
     raw_dl = findall('<a href="/datfile/(.*?)/">', get_downloads.text)
     #removing bios dats, coz they are broken and impossible to unpack
     dl = [item for item in raw_dl if not item.endswith('-bios')]
     log.debug(f"Got following entries to fetch: {dl}")
 
-    for item in dl:
-        download_link = f'{REDUMP_URL}/datfile/{item}/'
-        filename = f'redump-{item}.zip'
-        log.debug(f"Got downloads link: {download_link}. "
-                   "Trying to fetch archive (may take a while)")
-        datasheet_archive = SESSION.get(download_link)
-        log.debug(f"Successfully retrieved datasheets archive, attempting to save")
-        download_directory = join(DATASHEETS_DOWNLOAD_DIRECTORY, REDUMP_PREFIX)
-        file_processing.save_file(data = datasheet_archive.content,
-                                  filename = filename,
-                                  filedir = download_directory)
-        sleep(3) #smol pause to avoid getting banned for loads of requests
+    download_directory = join(DATASHEETS_DOWNLOAD_DIRECTORY, REDUMP_PREFIX)
+    #there are dozens of these, so fetching them in parallel. Amount of requests
+    #to redump at once is limited by LIMITER anyway
+    changed = False
+    with ThreadPoolExecutor(max_workers=HOST_CONCURRENCY) as pool:
+        futures = [pool.submit(download_file,
+                               f'{REDUMP_URL}/datfile/{item}/',
+                               filename = f'redump-{item}.zip',
+                               filedir = download_directory)
+                   for item in dl]
+        for future in as_completed(futures):
+            try:
+                changed = future.result() or changed
+            except Exception as e:
+                log.warning(f"Unable to fetch redump datasheet: {e}. Skipping")
+
+    return changed
 
 def get_mame():
     '''Downloads latest available mame dat pack in zip.
-    Saves into DATASHEETS_DOWNLOAD_DIRECTORY/MAME_PREFIX'''
+    Saves into DATASHEETS_DOWNLOAD_DIRECTORY/MAME_PREFIX.
+    Returns True if anything has been downloaded'''
     url = f'{MAME_URL}/release.php'
     log.debug(f"Attempting to download latest mame datasheet from {url}")
-    get_downloads = SESSION.get(url)
+    get_downloads = request('get', url)
     dl = findall('<a href="(.*?).zip">', get_downloads.text)
     download_link = f"{dl[0]}.zip"
-    log.debug(f"Got downloads link: {download_link}. "
-               "Trying to fetch archive (may take a while)")
-    datasheet_archive = SESSION.get(download_link)
-    log.debug(f"Successfully retrieved datasheets archive, attempting to save")
+    log.debug(f"Got downloads link: {download_link}")
     download_directory = join(DATASHEETS_DOWNLOAD_DIRECTORY, MAME_PREFIX)
-    file_processing.save_file(data = datasheet_archive.content,
-                              filename = 'mame.zip',
-                              filedir = download_directory)
+    return download_file(download_link,
+                         filename = 'mame.zip',
+                         filedir = download_directory)
 
 def datasheets_updater(sources:list):
     '''Match received sources against known prefixes, then for all matches -
     download related latest datasheets and unpack them into their subdirectories
     inside DEFAULT_DATASHEETS_DIRECTORY. If no valid arguments has been provided
-    - will batch-download all datasheets'''
+    - will batch-download all datasheets. Returns list of paths of datasheets
+    that have been added, changed or removed'''
     log.debug('Determining the list of download sources')
     #using sets to avoid situations when user supplied multiple arguments of same value
     #could only do that for non-default thing, but I want consistency
@@ -149,64 +288,238 @@ def datasheets_updater(sources:list):
         prefixes = default_prefixes
 
     log.debug(f'Got following prefixes: {prefixes}')
-    for prefix in prefixes:
-        if prefix == NOINTRO_PREFIX:
-            downloader = get_nointro
-        elif prefix == REDUMP_PREFIX:
-            downloader = get_redump
-        elif prefix == TOSEC_PREFIX:
-            downloader = get_tosec
-        elif prefix == MAME_PREFIX:
-            downloader = get_mame
-        else:
-            #it should NOT be possible to trigger this, Im just trying to be extra cautious
-            log.warning(f"Unknown prefix: {prefix}. Skipping")
-            continue
-
-        log.debug(f'Attempting to download latest datasheets from {prefix}')
-        try:
-            downloader()
-        except Exception as e:
-            log.warning(f"Unable to fetch latest datasheet: {e}. Skipping")
-            continue
-
-        log.debug(f"Getting the list of downloaded archives")
-        archive_directory = join(DATASHEETS_DOWNLOAD_DIRECTORY, prefix)
-        archives = file_processing.get_files(archive_directory)
-        if not archives:
-            log.debug(f"{archive_directory} contains no archives! Skipping")
-            continue
-
-        datasheets_directory = join(DEFAULT_DATASHEETS_DIRECTORY, prefix)
-        log.debug(f"Removing old datasheets from {datasheets_directory}")
-        #hopefully our user dont store anything of value inside datasheets_directory
-        old_datasheets = file_processing.get_files(datasheets_directory)
-        for f in old_datasheets:
+    downloaders = {
+        NOINTRO_PREFIX: get_nointro,
+        REDUMP_PREFIX: get_redump,
+        TOSEC_PREFIX: get_tosec,
+        MAME_PREFIX: get_mame,
+        }
+
+    changed_datasheets = []
+    #providers are hosted on different servers, so there is no reason to not
+    #download from all of them at once
+    with ThreadPoolExecutor(max_workers=len(prefixes)) as pool:
+        futures = {}
+        for prefix in prefixes:
+            log.debug(f'Attempting to download latest datasheets from {prefix}')
+            futures[pool.submit(downloaders[prefix])] = prefix
+
+        for future in as_completed(futures):
+            prefix = futures[future]
             try:
-                log.debug(f"Removing {f}")
-                remove(f)
+                changed = future.result()
             except Exception as e:
-                log.warning(f"Unable to remove {f}: {e}. Skipping")
+                log.warning(f"Unable to fetch latest datasheet: {e}. Skipping")
                 continue
 
-        log.debug(
-        f"Extracting datasheets from {archive_directory} to {datasheets_directory}"
-        )
-        for ar in archives:
-            #avoiding tosec-specific issue with archives containing non-dat garbage
-            if prefix == TOSEC_PREFIX:
-                fetch_dirs = ['TOSEC/', 'TOSEC-ISO/']
-                extractor_args = ar, datasheets_directory, fetch_dirs
-            else:
-                extractor_args = ar, datasheets_directory
-
             try:
-                file_processing.extract_zip(*extractor_args)
+                changed_datasheets.extend(extract_datasheets(prefix, changed))
             except Exception as e:
-                log.warning(
-                f"Unable to extract {ar} into {datasheets_directory}: {e}. Skipping"
-                )
-                continue
+                log.warning(f"Unable to update {prefix} datasheets: {e}. Skipping")
+
+    if changed_datasheets:
+        mark_updated()
+    return changed_datasheets
+
+def mark_updated():
+    '''Touches UPDATE_STAMP_PATH, to notify running daemon about new datasheets'''
+    makedirs(DEFAULT_DATASHEETS_DIRECTORY, exist_ok=True)
+    with open(UPDATE_STAMP_PATH, 'w') as f:
+        f.write(f"{time()}\n")
+    log.debug(f"Updated {UPDATE_STAMP_PATH}")
+
+def safe_member_path(name:str):
+    '''Returns normalized relative path of zip member, or None if it would end
+    up outside of output directory'''
+    path = normpath(name)
+    if isabs(path) or path.startswith('..'):
+        return None
+    return path
+
+def get_members(archives:list, extract_dirs:list = None):
+    '''Returns dictionary with relative paths of datasheets inside provided zip
+    archives as keys and (archive, ZipInfo) as values. If extract_dirs has been
+    provided - only includes members from these directories'''
+    members = {}
+    for ar in archives:
+        with ZipFile(ar, 'r') as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                #this may backfire, if 'f' doesnt end with '/'
+                #in case there are other files with names starting with 'f'
+                if extract_dirs and not any(info.filename.startswith(f) for f in extract_dirs):
+                    continue
+                path = safe_member_path(info.filename)
+                if path is None:
+                    log.warning(f"{ar} contains unsafe path {info.filename}. Skipping")
+                    continue
+                members[path] = (ar, info)
+    return members
+
+def load_manifest(datasheets_directory:str):
+    '''Returns dictionary with crc and size of each datasheet, as they were
+    during previous update'''
+    try:
+        with open(join(datasheets_directory, MANIFEST_NAME), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        log.warning(f"Unable to read manifest of {datasheets_directory}: {e}")
+        return {}
+
+def is_unchanged(path:str, info, manifest:dict, relpath:str):
+    '''Returns True if datasheet on path is the same as provided zip member'''
+    try:
+        size = stat(path).st_size
+    except OSError:
+        return False
+    if size != info.file_size:
+        return False
+    if relpath in manifest:
+        return manifest[relpath] == [info.CRC, info.file_size]
+    #datasheets extracted before manifests were introduced have to be checked
+    #manually. This only happens once
+    return int(hashcheck.crc32sum(path), 16) == info.CRC
+
+def relpath_of(path:str, directory:str):
+    return normpath(relpath(path, directory))
+
+def link_or_copy(source:str, destination:str):
+    makedirs(dirname(destination), exist_ok=True)
+    try:
+        link(source, destination)
+    except OSError:
+        copy2(source, destination)
+
+#flag of renameat2, that makes it swap two paths
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+
+def exchange_paths(first:str, second:str):
+    '''Atomically swaps two existing paths with each other, via linux's renameat2.
+    Returns False if its not supported by system or filesystem'''
+    #ctypes is only needed once per update, thus isnt imported beforehand
+    import ctypes
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return False
+    renameat2.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+                          ctypes.c_char_p, ctypes.c_uint)
+    if not renameat2(AT_FDCWD, fsencode(first), AT_FDCWD, fsencode(second),
+                     RENAME_EXCHANGE):
+        return True
+    errno = ctypes.get_errno()
+    #kernel or filesystem doesnt support that flag
+    if errno in (EINVAL, ENOSYS, EOPNOTSUPP):
+        return False
+    raise OSError(errno, strerror(errno), first, None, second)
+
+def swap_directories(staging_directory:str, directory:str, backup_directory:str):
+    '''Replaces directory with staging_directory, removing the old one. Where
+    possible, paths are exchanged atomically. Otherwise old directory is moved
+    to backup_directory first - if process dies right after, its restored by
+    restore_interrupted on next update'''
+    if not isdir(directory):
+        rename(staging_directory, directory)
+        return
+    if exchange_paths(staging_directory, directory):
+        #old datasheets are inside staging directory now
+        rmtree(staging_directory)
+        return
+    rename(directory, backup_directory)
+    rename(staging_directory, directory)
+    rmtree(backup_directory)
+
+def restore_interrupted(directory:str, backup_directory:str):
+    '''Moves backup made by swap_directories back in place, if update has been
+    interrupted before staging directory took place of the old one'''
+    if isdir(backup_directory) and not isdir(directory):
+        log.warning(f"Previous update of {directory} has been interrupted, "
+                    f"restoring its datasheets from {backup_directory}")
+        rename(backup_directory, directory)
+
+def extract_datasheets(prefix:str, changed:bool = True):
+    '''Updates datasheets of provided prefix with these from its downloaded
+    archives. Only datasheets that differ from already extracted (by crc and size
+    from zip's central directory) are written. New set of datasheets is prepared
+    in staging directory and then swapped with the current one, so datasheets
+    directory is never left empty or half-updated.
+    Returns list of paths of datasheets that have been added, changed or removed'''
+    datasheets_directory = join(DEFAULT_DATASHEETS_DIRECTORY, prefix)
+    staging_directory = join(DEFAULT_DATASHEETS_DIRECTORY, f".{prefix}.staging")
+    backup_directory = join(DEFAULT_DATASHEETS_DIRECTORY, f".{prefix}.old")
+    restore_interrupted(datasheets_directory, backup_directory)
+    manifest = load_manifest(datasheets_directory)
+    if not changed and manifest:
+        log.info(f"{prefix} datasheets are up to date")
+        return []
+
+    log.debug(f"Getting the list of downloaded archives")
+    archive_directory = join(DATASHEETS_DOWNLOAD_DIRECTORY, prefix)
+    archives = file_processing.get_files(archive_directory)
+    if not archives:
+        log.debug(f"{archive_directory} contains no archives! Skipping")
+        return []
+
+    #avoiding tosec-specific issue with archives containing non-dat garbage
+    extract_dirs = None
+    if prefix == TOSEC_PREFIX:
+        extract_dirs = ['TOSEC/', 'TOSEC-ISO/']
+    members = get_members(archives, extract_dirs)
+
+    for leftover in (staging_directory, backup_directory):
+        if isdir(leftover):
+            rmtree(leftover)
+    makedirs(staging_directory)
+
+    log.debug(f"Preparing updated datasheets in {staging_directory}")
+    new_manifest = {}
+    changed_paths = []
+    open_archives = {}
+    try:
+        for relpath, (ar, info) in sorted(members.items()):
+            current_path = join(datasheets_directory, relpath)
+            staging_path = join(staging_directory, relpath)
+            if is_unchanged(current_path, info, manifest, relpath):
+                link_or_copy(current_path, staging_path)
             else:
-                log.debug(f"Removing {ar} from cache")
-                remove(ar)
+                log.debug(f"Extracting {relpath} from {ar}")
+                if ar not in open_archives:
+                    open_archives[ar] = ZipFile(ar, 'r')
+                makedirs(dirname(staging_path), exist_ok=True)
+                with open_archives[ar].open(info) as source, open(staging_path, 'wb') as f:
+                    copyfileobj(source, f, DOWNLOAD_CHUNK_SIZE)
+                changed_paths.append(current_path)
+            new_manifest[relpath] = [info.CRC, info.file_size]
+    except:
+        rmtree(staging_directory)
+        raise
+    finally:
+        for zf in open_archives.values():
+            zf.close()
+
+    try:
+        old_datasheets = file_processing.get_files(datasheets_directory)
+    except FileNotFoundError:
+        old_datasheets = []
+    #hopefully our user dont store anything of value inside datasheets_directory
+    removed_paths = [f for f in old_datasheets
+                     if relpath_of(f, datasheets_directory) not in new_manifest
+                     and basename(f) != MANIFEST_NAME]
+    changed_paths.extend(removed_paths)
+
+    with open(join(staging_directory, MANIFEST_NAME), 'w') as f:
+        json.dump(new_manifest, f)
+
+    log.debug(f"Swapping {datasheets_directory} with {staging_directory}")
+    swap_directories(staging_directory, datasheets_directory, backup_directory)
+
+    #so outdated compiled datasheets wont be loaded by accident
+    for path in changed_paths:
+        datasheet_cache.remove_cache(path)
+
+    log.info(f"Updated {len(changed_paths)} out of {len(new_manifest)} {prefix} datasheets")
+    return changed_paths
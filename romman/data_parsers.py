@@ -17,96 +17,188 @@
 # This module contains functions related to obtaining data from datasheets
 
 import logging
-from lxml import etree
 
 log = logging.getLogger(__name__)
 
+#root tag of datasheet: tags of its game entries
+DAT_FORMAT = 'datafile'
+MAME_FORMAT = 'mame'
+DATASHEET_FORMATS = {
+    #some logiqx dats (say, these made by clrmamepro) use "machine" too
+    DAT_FORMAT: ('game', 'machine'),
+    MAME_FORMAT: ('machine',),
+    }
+MAME_GROUP = "MAME"
+MAME_CATEGORY = "mamedev"
+
+SNIFF_CHUNK_SIZE = 64 * 1024
+#if there is no root element in that many first bytes - its certainly not datasheet
+MAX_SNIFF_SIZE = 1024 * 1024
+
+def get_etree():
+    '''Returns lxml.etree. Its imported on first use, so things that never parse
+    datasheets (say, cli help or cached runs) dont spend time on that'''
+    from lxml import etree
+    return etree
+
+def clear_element(item):
+    '''Removes already processed element and all its preceding siblings from
+    memory, to avoid swimming in ram during iterative parsing'''
+    #removing the item itself
+    item.clear()
+    #removing all non-empty references to that item
+    #I know how it looks, but this check is there to avoid "FutureWarning"
+    while item.getprevious() is not None:
+        del item.getparent()[0]
+
+def sniff_format(stream):
+    '''Reads first bytes of provided binary stream until its root element and
+    returns root's tag. Stream is not rewinded afterwards'''
+    parser = get_etree().XMLPullParser(events=('start',))
+    read_size = 0
+    while read_size < MAX_SNIFF_SIZE:
+        chunk = stream.read(SNIFF_CHUNK_SIZE)
+        if not chunk:
+            break
+        read_size += len(chunk)
+        parser.feed(chunk)
+        for event, item in parser.read_events():
+            return item.tag
+
+    raise ValueError("unable to find root element")
+
+def parse_header(item):
+    '''Returns group (usually name of console) and category (nointro/redump/etc)
+    from provided header element'''
+    group = item.find('name').text
+    try:
+        category = item.find('homepage').text
+    except:
+        #this tag presents in non-iso tosec dumps INSTEAD of "homepage"
+        category = item.find('category').text
+
+    return group, category
+
+def parse_game(item, group:str, category:str):
+    '''Returns list with data of roms from provided game element'''
+    data_list = []
+    game_name = item.find('description').text
+    #checked once per game, coz its called for each entry of huge datasheets
+    debug = log.isEnabledFor(logging.DEBUG)
+    for entry in item.iterfind('rom'):
+        #this will reduce ram usage even further, coz we only log necessary
+        #info of matching entries
+        entry_data = {}
+        entry_data['name'] = entry.attrib['name']
+        try:
+            #applying 'lower', coz nointro has hashes in caps
+            entry_data['crc'] = entry.attrib['crc'].lower()
+        except KeyError:
+            log.debug("%s has no valid hash information. Skipping",
+                      entry_data['name'])
+            continue
+        #not every datasheet has these, so they are optional
+        if entry.attrib.get('size', '').isdigit():
+            entry_data['size'] = int(entry.attrib['size'])
+        for digest in ('md5', 'sha1', 'sha256'):
+            if digest in entry.attrib:
+                entry_data[digest] = entry.attrib[digest].lower()
+        entry_data['game'] = game_name
+        entry_data['group'] = group
+        entry_data['category'] = category
+
+        if debug:
+            log.debug("Got following info: %s", entry_data)
+        data_list.append(entry_data)
+
+    return data_list
+
+def iter_datasheet(stream, name:str, formats:tuple = None):
+    '''Yields data of roms from provided binary stream of datasheet. For details,
+    see parse_datasheet'''
+    root = sniff_format(stream)
+    if root not in DATASHEET_FORMATS or (formats and root not in formats):
+        raise ValueError(f"{name} has unsupported format: <{root}>")
+    log.debug("%s seems to be <%s> datasheet", name, root)
+    stream.seek(0)
+
+    game_tags = DATASHEET_FORMATS[root]
+    if root == MAME_FORMAT:
+        group, category = MAME_GROUP, MAME_CATEGORY
+    else:
+        #header always goes before games, so these will be set in time
+        group = category = None
+
+    roms_amount = 0
+    raw_items = get_etree().iterparse(stream, events=('end',), tag=('header',) + game_tags)
+    for event, item in raw_items:
+        if item.tag == 'header':
+            group, category = parse_header(item)
+            log.debug("Got following header data: %s, %s", group, category)
+        else:
+            for entry_data in parse_game(item, group, category):
+                roms_amount += 1
+                yield entry_data
+        clear_element(item)
+
+    log.debug("Obtained %s roms from %s", roms_amount, name)
+
+def parse_datasheet(datafile, formats:tuple = None):
+    '''Yields data of roms from provided datasheet (path or binary file object),
+    reading it in one pass. Format of datasheet (standard DAT or mame xml) is
+    determined by its root element, regardless of extension. If formats have
+    been provided - only datasheets with these root elements are accepted,
+    others throw ValueError without being parsed'''
+    if isinstance(datafile, str):
+        log.debug("Processing datasheet: %s", datafile)
+        with open(datafile, 'rb') as f:
+            yield from iter_datasheet(f, datafile, formats)
+    else:
+        name = getattr(datafile, 'name', repr(datafile))
+        log.debug("Processing datasheet: %s", name)
+        yield from iter_datasheet(datafile, name, formats)
+
 def dat_header_fetcher(datafile:str):
     '''Fetches group (usually name of console) and category (nointro/redump/etc)
     from provided datafile and returns them'''
-    log.debug(f"Attempting to fetch header from {datafile}")
+    log.debug("Attempting to fetch header from %s", datafile)
     #events expect tuple, so its like that
-    raw_header = etree.iterparse(datafile, events=('end',), tag='header')
+    raw_header = get_etree().iterparse(datafile, events=('end',), tag='header')
 
     for event, item in raw_header:
-        group = item.find('name').text
-        try:
-            category = item.find('homepage').text
-        except:
-            #this tag presents in non-iso tosec dumps INSTEAD of "homepage"
-            category = item.find('category').text
-        #clearing up the stuff (just to be safe)
-        item.clear()
-        while item.getprevious() is not None:
-            del item.getparent()[0]
+        group, category = parse_header(item)
+        log.debug("Got following header data: %s, %s", group, category)
+        #header is at the very top, no need to parse the rest of file
+        return group, category
 
-    log.debug(f"Got following header data: {group}, {category}")
-
-    return group, category
+    raise ValueError(f"{datafile} has no header")
 
 def roms_fetcher(datafile:str, tag:str, group:str, category:str):
     '''Returns list with games data from provided datafile'''
-    log.debug(f"Attempting to info about roms from {datafile}")
-    raw_roms = etree.iterparse(datafile, events=('end',), tag=tag)
+    log.debug("Attempting to info about roms from %s", datafile)
+    raw_roms = get_etree().iterparse(datafile, events=('end',), tag=tag)
 
     data_list = []
     for event, item in raw_roms:
-        game_name = item.find('description').text
-        for entry in item.findall('rom'):
-            #this will reduce ram usage even further, coz we only log necessary
-            #info of matching entries
-            entry_data = {}
-            entry_data['name'] = entry.attrib['name']
-            try:
-                #if I will ever decide to implement md5/sha1 verification - this
-                #will need adjustments
-                #applying 'lower', coz nointro has hashes in caps
-                entry_data['crc'] = entry.attrib['crc'].lower()
-            except KeyError:
-                log.debug(
-                f"{entry_data['name']} has no valid hash information. Skipping"
-                )
-                continue
-            entry_data['game'] = game_name
-            entry_data['group'] = group
-            entry_data['category'] = category
-
-            log.debug(f"Got following info: {entry_data}")
-            data_list.append(entry_data)
-            entry.clear()
-        #now cleaning up the stuff from memory, to avoid swimming in ram
-        #removing the item itself
-        item.clear()
-        #removing all non-empty references to that item
-        #I know how it looks, but this check is there to avoid "FutureWarning"
-        while item.getprevious() is not None:
-            del item.getparent()[0]
-
-    log.debug(f"Obtained {len(data_list)} roms from {datafile}")
+        data_list.extend(parse_game(item, group, category))
+        clear_element(item)
+
+    log.debug("Obtained %s roms from %s", len(data_list), datafile)
     return data_list
 
 def dat_file(datafile:str):
     '''Returns list with game data from dat file.
     Only standard DAT is supported - attempting to parse other xmls will throw
     error, due to different internal structure'''
-    log.debug(f"Processing datasheet: {datafile}")
-
-    group, category = dat_header_fetcher(datafile)
-    tag = "game"
-    data = roms_fetcher(datafile, tag, group, category)
+    data = list(parse_datasheet(datafile, (DAT_FORMAT,)))
 
-    log.debug(f"Successfully fetched data from {datafile}, returning")
+    log.debug("Successfully fetched data from %s, returning", datafile)
     return data
 
 def mame_xml(xmlfile:str):
     '''Returns list with game data from xml file.
     Only xml from zip from https://www.mamedev.org/release.php is supported'''
+    data = list(parse_datasheet(xmlfile, (MAME_FORMAT,)))
 
-    log.debug(f"Processing mame xml: {xmlfile}")
-    group, category = "MAME", "mamedev"
-    tag = "machine"
-    data = roms_fetcher(xmlfile, tag, group, category)
-
-    log.debug(f"Successfully fetched data from {xmlfile}, returning")
+    log.debug("Successfully fetched data from %s, returning", xmlfile)
     return data
-
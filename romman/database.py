@@ -0,0 +1,398 @@
+## Romman - utility to compare your console ROMs with accuracy-focused datasheets
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module contains in-memory index of datasheet entries
+
+import logging
+import sqlite3
+import weakref
+from collections import namedtuple
+from os import close, makedirs, remove
+from sys import intern, getsizeof
+from tempfile import mkstemp
+from romman import configuration
+
+log = logging.getLogger(__name__)
+
+CACHE_DIRECTORY = configuration.CACHE_DIRECTORY
+#approximate memory used by index's dict to store single entry
+INDEX_SLOT_SIZE = 100
+#amount of entries to write into spilled database at once
+SPILL_BATCH_SIZE = 10000
+
+#shared by all entries of the same datasheet, instead of each entry storing its own
+#references to group and category strings
+Datasheet = namedtuple('Datasheet', ['group', 'category'])
+
+def crc_key(crc):
+    '''Converts crc (either int or hex str, with or without leading zeroes) into
+    int, usable as index key. Returns None if crc is empty'''
+    if crc is None or crc == '':
+        return None
+    if isinstance(crc, int):
+        return crc
+    return int(crc, 16)
+
+def digest_key(digest):
+    '''Converts hex str digest (md5/sha1/sha256) into bytes, which take half of
+    the space. Returns None if digest is empty'''
+    if not digest:
+        return None
+    if isinstance(digest, bytes):
+        return digest
+    return bytes.fromhex(digest)
+
+class RomEntry:
+    '''Compact representation of single datasheet entry. Crc is stored as int,
+    other digests - as bytes'''
+    __slots__ = ('name', 'game', 'crc', 'size', 'md5', 'sha1', 'sha256', 'datasheet')
+
+    def __init__(self, name:str, game:str, crc:int, size:int, md5:bytes,
+                 sha1:bytes, sha256:bytes, datasheet:Datasheet):
+        self.name = name
+        self.game = game
+        self.crc = crc
+        self.size = size
+        self.md5 = md5
+        self.sha1 = sha1
+        self.sha256 = sha256
+        self.datasheet = datasheet
+
+    @property
+    def group(self):
+        return self.datasheet.group
+
+    @property
+    def category(self):
+        return self.datasheet.category
+
+    def identity(self):
+        '''Returns tuple of values that make entry unique. Entries with the same
+        identity are considered duplicates (say, the same rom of mame clone sets)'''
+        return (self.name, self.crc, self.size, self.md5, self.sha1, self.sha256,
+                self.datasheet)
+
+    def as_dict(self):
+        '''Returns json-friendly dictionary with data of entry, with crc and
+        other digests as hex strings'''
+        return {
+            'name': self.name,
+            'game': self.game,
+            'group': self.group,
+            'category': self.category,
+            'crc': f"{self.crc:08x}",
+            'size': self.size,
+            'md5': self.md5.hex() if self.md5 else None,
+            'sha1': self.sha1.hex() if self.sha1 else None,
+            'sha256': self.sha256.hex() if self.sha256 else None,
+            }
+
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        for attr, value in zip(self.__slots__, state):
+            setattr(self, attr, value)
+
+    def __repr__(self):
+        return (f"RomEntry(name={self.name!r}, crc={self.crc:08x}, "
+                f"size={self.size}, datasheet={self.datasheet})")
+
+def compile_entries(entries):
+    '''Converts datasheet entries (as returned by data_parsers) into compact
+    picklable chunks: list of ((group, category), rows) tuples, where each row
+    is tuple of RomEntry attributes (except datasheet). Entries without crc are
+    dropped. Used to cache datasheets and send them between processes'''
+    chunks = {}
+    for entry in entries:
+        crc = crc_key(entry.get('crc'))
+        if crc is None:
+            continue
+        row = (
+            entry['name'],
+            entry.get('game'),
+            crc,
+            entry.get('size'),
+            digest_key(entry.get('md5')),
+            digest_key(entry.get('sha1')),
+            digest_key(entry.get('sha256')),
+            )
+        key = (entry.get('group'), entry.get('category'))
+        chunks.setdefault(key, []).append(row)
+
+    return list(chunks.items())
+
+def remove_spilled(connection, path:str):
+    connection.close()
+    try:
+        remove(path)
+    except FileNotFoundError:
+        pass
+
+class Database:
+    '''Index of datasheet entries (as returned by data_parsers.roms_fetcher),
+    grouped by their crc. Lookups cost O(1) instead of scanning all entries.
+    Entries are stored as RomEntry, with duplicates collapsed.
+    If max_memory (in bytes) has been provided and index grows beyond it - all
+    entries are moved into temporary sqlite database inside CACHE_DIRECTORY,
+    and all further lookups are done via indexed queries to it'''
+    def __init__(self, entries:list = None, max_memory:int = None):
+        #crc: RomEntry, or list of RomEntry if there are multiple entries with
+        #that crc. Most crcs are unique, so this saves a list per entry
+        self.index = {}
+        #to share one Datasheet instance between all entries of it
+        self.datasheets = {}
+        #sizes of all indexed entries, to skip hashing files that cant match
+        #anything. Becomes None if some entry has no size, coz then any file may match
+        self.sizes = set()
+        self.entries_amount = 0
+        self.duplicates_amount = 0
+
+        self.max_memory = max_memory
+        self.memory_estimate = 0
+        #set once database has been spilled to disk
+        self.connection = None
+        self.spill_path = None
+        self.pending_rows = []
+        self.datasheet_ids = {}
+        self.datasheets_by_id = []
+
+        if entries:
+            self.extend(entries)
+
+    def get_datasheet(self, group:str, category:str):
+        '''Returns shared Datasheet instance with provided group and category'''
+        key = (group, category)
+        datasheet = self.datasheets.get(key)
+        if datasheet is None:
+            datasheet = Datasheet(group, category)
+            self.datasheets[key] = datasheet
+        return datasheet
+
+    def add(self, entry:dict):
+        '''Adds single datasheet entry to index'''
+        key = crc_key(entry.get('crc'))
+        if key is None:
+            log.debug(f"{entry.get('name')} has no crc, wont index it")
+            return
+
+        rom = RomEntry(
+            name = intern(entry['name']),
+            game = intern(entry['game']) if entry.get('game') else None,
+            crc = key,
+            size = entry.get('size'),
+            md5 = digest_key(entry.get('md5')),
+            sha1 = digest_key(entry.get('sha1')),
+            sha256 = digest_key(entry.get('sha256')),
+            datasheet = self.get_datasheet(entry.get('group'), entry.get('category')),
+            )
+        self.add_entry(rom)
+
+    def add_entry(self, rom:RomEntry):
+        '''Adds already compacted RomEntry to index, unless its duplicate'''
+        if self.sizes is not None:
+            if rom.size is None:
+                log.debug(f"{rom.name} has no size, disabling size checks")
+                self.sizes = None
+            else:
+                self.sizes.add(rom.size)
+
+        if self.connection is not None:
+            self.pending_rows.append(self.to_row(rom))
+            if len(self.pending_rows) >= SPILL_BATCH_SIZE:
+                self.write_pending()
+            return
+
+        existing = self.index.get(rom.crc)
+        if existing is None:
+            self.index[rom.crc] = rom
+        else:
+            if isinstance(existing, RomEntry):
+                existing = [existing]
+            identity = rom.identity()
+            if any(item.identity() == identity for item in existing):
+                self.duplicates_amount += 1
+                return
+            existing.append(rom)
+            self.index[rom.crc] = existing
+
+        self.entries_amount += 1
+        if self.max_memory is not None:
+            self.memory_estimate += self.estimate_size(rom)
+            if self.memory_estimate > self.max_memory:
+                self.spill()
+
+    def extend(self, entries:list):
+        '''Adds all provided datasheet entries to index'''
+        for entry in entries:
+            self.add(entry)
+
+    def merge(self, chunks:list):
+        '''Adds entries from chunks, made by compile_entries, to index'''
+        for (group, category), rows in chunks:
+            datasheet = self.get_datasheet(group, category)
+            for name, game, crc, size, md5, sha1, sha256 in rows:
+                self.add_entry(RomEntry(
+                    name = intern(name),
+                    game = intern(game) if game else None,
+                    crc = crc,
+                    size = size,
+                    md5 = md5,
+                    sha1 = sha1,
+                    sha256 = sha256,
+                    datasheet = datasheet,
+                    ))
+
+    def estimate_size(self, rom:RomEntry):
+        '''Returns approximate amount of memory, used to store provided entry'''
+        size = getsizeof(rom) + getsizeof(rom.name) + INDEX_SLOT_SIZE
+        for digest in (rom.md5, rom.sha1, rom.sha256):
+            if digest is not None:
+                size += getsizeof(digest)
+        return size
+
+    def get_datasheet_id(self, datasheet:Datasheet):
+        datasheet_id = self.datasheet_ids.get(datasheet)
+        if datasheet_id is None:
+            datasheet_id = len(self.datasheets_by_id)
+            self.datasheets_by_id.append(datasheet)
+            self.datasheet_ids[datasheet] = datasheet_id
+        return datasheet_id
+
+    def to_row(self, rom:RomEntry):
+        #sqlite treats NULLs as distinct values in unique constraints, thus empty
+        #values are stored as -1 and empty blobs, to make duplicates detectable
+        return (rom.crc, rom.name, rom.game,
+                -1 if rom.size is None else rom.size,
+                rom.md5 or b'', rom.sha1 or b'', rom.sha256 or b'',
+                self.get_datasheet_id(rom.datasheet))
+
+    def from_row(self, row:tuple):
+        crc, name, game, size, md5, sha1, sha256, datasheet_id = row
+        return RomEntry(
+            name = name,
+            game = game,
+            crc = crc,
+            size = None if size == -1 else size,
+            md5 = md5 or None,
+            sha1 = sha1 or None,
+            sha256 = sha256 or None,
+            datasheet = self.datasheets_by_id[datasheet_id],
+            )
+
+    def spill(self):
+        '''Moves all entries from memory into temporary sqlite database'''
+        makedirs(CACHE_DIRECTORY, exist_ok=True)
+        fd, self.spill_path = mkstemp(prefix='index-', suffix='.sqlite',
+                                      dir=CACHE_DIRECTORY)
+        close(fd)
+        log.info(f"Database has exceeded {self.max_memory // (1024 * 1024)}MB, "
+                 f"moving {self.entries_amount} entries into {self.spill_path}")
+
+        self.connection = sqlite3.connect(self.spill_path, check_same_thread=False)
+        #its temporary file, so there is no reason to care about its integrity
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute(
+            "CREATE TABLE entries (crc INTEGER, name TEXT, game TEXT, size INTEGER, "
+            "md5 BLOB, sha1 BLOB, sha256 BLOB, datasheet INTEGER, "
+            "UNIQUE (crc, name, size, md5, sha1, sha256, datasheet))"
+            )
+        self.connection.execute("CREATE INDEX entries_crc ON entries (crc)")
+        self._finalizer = weakref.finalize(self, remove_spilled,
+                                           self.connection, self.spill_path)
+
+        for entries in self.index.values():
+            if isinstance(entries, RomEntry):
+                entries = [entries]
+            self.pending_rows.extend(self.to_row(rom) for rom in entries)
+        self.index = {}
+        #these have already been counted once
+        self.entries_amount -= len(self.pending_rows)
+        self.write_pending()
+        self.memory_estimate = 0
+
+    def write_pending(self):
+        '''Writes entries, added since last call, into spilled database'''
+        if not self.pending_rows:
+            return
+        with self.connection:
+            changes_before = self.connection.total_changes
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                self.pending_rows)
+            added = self.connection.total_changes - changes_before
+        self.entries_amount += added
+        self.duplicates_amount += len(self.pending_rows) - added
+        self.pending_rows = []
+
+    def get_candidates(self, key:int):
+        '''Returns list of all entries with provided crc key'''
+        if self.connection is not None:
+            self.write_pending()
+            rows = self.connection.execute(
+                "SELECT crc, name, game, size, md5, sha1, sha256, datasheet "
+                "FROM entries WHERE crc = ? ORDER BY rowid", (key,))
+            return [self.from_row(row) for row in rows]
+
+        candidates = self.index.get(key)
+        if candidates is None:
+            return []
+        if isinstance(candidates, RomEntry):
+            return [candidates]
+        return candidates
+
+    def find(self, crc, size:int = None, md5:str = None, sha1:str = None,
+             sha256:str = None):
+        '''Returns list of entries matching provided crc. If any of optional
+        arguments has been provided - also filters out entries that have these
+        set to different values. Entries without these keys are not filtered'''
+        key = crc_key(crc)
+        if key is None:
+            return []
+        candidates = self.get_candidates(key)
+
+        #secondary keys are optional, coz not every datasheet has them
+        secondary = {
+            'size': size,
+            'md5': digest_key(md5),
+            'sha1': digest_key(sha1),
+            'sha256': digest_key(sha256),
+            }
+        for name, value in secondary.items():
+            if value is None:
+                continue
+            candidates = [entry for entry in candidates
+                          if getattr(entry, name) is None or getattr(entry, name) == value]
+
+        return candidates
+
+    def close(self):
+        '''Removes spilled database, if there is any'''
+        if self.connection is not None:
+            self._finalizer()
+            self.connection = None
+
+    def __contains__(self, crc):
+        key = crc_key(crc)
+        if key is None:
+            return False
+        return bool(self.get_candidates(key))
+
+    def __len__(self):
+        if self.connection is not None:
+            self.write_pending()
+        return self.entries_amount
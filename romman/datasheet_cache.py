@@ -0,0 +1,275 @@
+## Romman - utility to compare your console ROMs with accuracy-focused datasheets
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module contains functions related to caching already parsed datasheets
+
+import logging
+import pickle
+from hashlib import sha1
+from tempfile import mkstemp
+from concurrent.futures import as_completed
+from os import makedirs, remove, replace, stat, fdopen
+from os.path import join, abspath
+from collections import namedtuple
+from zipfile import ZipFile, is_zipfile
+from romman import configuration, data_parsers, database, file_processing, bloom, metrics
+
+log = logging.getLogger(__name__)
+
+CACHE_DIRECTORY = configuration.CACHE_DIRECTORY
+DATASHEETS_CACHE_DIRECTORY = join(CACHE_DIRECTORY, 'Datasheets')
+#bump this each time format of cached data changes, to make old caches invalid
+CACHE_VERSION = 6
+
+DATASHEET_EXTENSIONS = ('.dat', '.xml')
+#hidden files inside datasheets directories are updater's service files (say,
+#manifests and update stamps), not datasheets
+SERVICE_FILES = ['.*']
+
+class DatasheetSummary(namedtuple('DatasheetSummary', ['crcs', 'sizes'])):
+    '''Bloom filters of crcs and sizes of all entries of datasheet. Sizes filter
+    is None if some entries have no size'''
+    __slots__ = ()
+
+    def may_contain(self, crc:int, size:int = None):
+        '''Returns False if datasheet surely has no entry with provided crc and
+        size (None if unknown), and True if it may have one'''
+        if crc not in self.crcs:
+            return False
+        return size is None or self.sizes is None or size in self.sizes
+
+class ArchivedDatasheet(namedtuple('ArchivedDatasheet', ['archive', 'member', 'crc', 'size'])):
+    '''Datasheet stored inside zip archive, with crc and size of it, as listed
+    in archive's central directory'''
+    __slots__ = ()
+
+    def __str__(self):
+        return join(self.archive, self.member)
+
+def list_datasheets(datafile:str):
+    '''Returns list with provided datafile itself or, if its zip archive -
+    with ArchivedDatasheet for each of .dat and .xml files inside'''
+    if not is_zipfile(datafile):
+        return [datafile]
+
+    log.debug(f"{datafile} is zip archive, listing datasheets inside")
+    datasheets = []
+    with ZipFile(datafile, 'r') as zf:
+        for info in zf.infolist():
+            if info.is_dir() or not info.filename.lower().endswith(DATASHEET_EXTENSIONS):
+                continue
+            datasheets.append(ArchivedDatasheet(datafile, info.filename,
+                                                info.CRC, info.file_size))
+    return datasheets
+
+def find_datasheets(paths:list):
+    '''Returns list of datasheets (paths or ArchivedDatasheet, see
+    list_datasheets) inside provided files and directories. Zip archives are
+    listed as is, without extracting datasheets out of them'''
+    datafiles = []
+    for path in paths:
+        try:
+            files = file_processing.get_files(path, exclude=SERVICE_FILES)
+        except FileNotFoundError:
+            #ensuring that directory user will be pointed to exists
+            if path == configuration.DEFAULT_DATASHEETS_DIRECTORY:
+                makedirs(path, exist_ok=True)
+            else:
+                log.warning(f"{path} doesnt exist. Skipping")
+            continue
+        except Exception as e:
+            log.warning(f"Couldnt process datasheets on path {path}: {e}. Skipping")
+            continue
+
+        for f in files:
+            try:
+                datafiles.extend(list_datasheets(f))
+            except Exception as e:
+                log.warning(f"Couldnt process data file {f}: {e}. Skipping")
+    return datafiles
+
+def cache_path(datafile, extension:str = 'pickle'):
+    '''Returns path to compiled cache file of provided datasheet (or, depending
+    on extension, to other cached data about it)'''
+    if isinstance(datafile, ArchivedDatasheet):
+        identifier = join(abspath(datafile.archive), datafile.member)
+    else:
+        identifier = abspath(datafile)
+    key = sha1(identifier.encode('utf-8')).hexdigest()
+    return join(DATASHEETS_CACHE_DIRECTORY, f"{key}.{extension}")
+
+def datasheet_signature(datafile):
+    '''Returns tuple that identifies current state of datasheet on disk'''
+    if isinstance(datafile, ArchivedDatasheet):
+        #no need to even open archive - its central directory has crc of member
+        return (CACHE_VERSION, abspath(datafile.archive), datafile.member,
+                datafile.crc, datafile.size)
+    st = stat(datafile)
+    return (CACHE_VERSION, abspath(datafile), st.st_size, st.st_mtime_ns)
+
+def parse_datasheet(datafile):
+    '''Yields entries of provided datasheet, as soon as these are parsed.
+    Datasheets inside zip archives are streamed right out of them, without
+    extracting'''
+    if isinstance(datafile, ArchivedDatasheet):
+        with ZipFile(datafile.archive, 'r') as zf:
+            with zf.open(datafile.member) as f:
+                yield from data_parsers.parse_datasheet(f)
+        return
+    yield from data_parsers.parse_datasheet(datafile)
+
+def read_cached(datafile, extension:str):
+    '''Returns data cached for provided datasheet under provided extension, or
+    None if there is no valid cache for its current state'''
+    signature = datasheet_signature(datafile)
+    try:
+        with open(cache_path(datafile, extension), 'rb') as f:
+            cached_signature = pickle.load(f)
+            if cached_signature != signature:
+                log.debug(f"Cache of {datafile} is outdated")
+                return None
+            return pickle.load(f)
+    except FileNotFoundError:
+        log.debug(f"{datafile} has no cache yet")
+    except Exception as e:
+        log.warning(f"Cache of {datafile} seems to be damaged: {e}. Ignoring")
+
+    return None
+
+def write_cached(datafile, extension:str, data):
+    '''Saves provided data about datasheet into cache, under provided extension'''
+    makedirs(DATASHEETS_CACHE_DIRECTORY, exist_ok=True)
+    path = cache_path(datafile, extension)
+    #writing into temporary file first, to never leave half-written caches around.
+    #Its unique, coz multiple runs (say, daemon and cli) may cache the same datasheet
+    fd, temp_path = mkstemp(dir=DATASHEETS_CACHE_DIRECTORY, suffix='.tmp')
+    try:
+        with fdopen(fd, 'wb') as f:
+            pickle.dump(datasheet_signature(datafile), f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        replace(temp_path, path)
+    except BaseException:
+        remove(temp_path)
+        raise
+    log.debug(f"Saved cache of {datafile} as {path}")
+
+def read_cache(datafile):
+    '''Returns cached chunks of provided datasheet or None, if there is no valid
+    cache for its current state'''
+    return read_cached(datafile, 'pickle')
+
+def write_cache(datafile, chunks:list):
+    '''Saves chunks of provided datasheet into cache, alongside with its summary'''
+    write_cached(datafile, 'pickle', chunks)
+    write_cached(datafile, 'summary', make_summary(chunks))
+
+def make_summary(chunks:list):
+    '''Returns DatasheetSummary of provided chunks'''
+    crcs = set()
+    sizes = set()
+    for datasheet, rows in chunks:
+        for row in rows:
+            crcs.add(row[2])
+            sizes.add(row[3])
+
+    crc_filter = bloom.BloomFilter(len(crcs))
+    crc_filter.update(crcs)
+    #if some entry has no size - file of any size may match it
+    size_filter = None
+    if None not in sizes:
+        size_filter = bloom.BloomFilter(len(sizes))
+        size_filter.update(sizes)
+
+    return DatasheetSummary(crc_filter, size_filter)
+
+def read_summary(datafile):
+    '''Returns DatasheetSummary of provided datasheet or None, if it wasnt
+    cached yet (or changed since)'''
+    return read_cached(datafile, 'summary')
+
+def load_datasheet(datafile, parser = parse_datasheet):
+    '''Returns entries of provided datasheet, compiled into chunks by
+    database.compile_entries. If datasheet didnt change since last run - loads
+    them from cache, else parses with provided parser and updates the cache'''
+    chunks = read_cache(datafile)
+    if chunks is not None:
+        log.debug(f"Loaded {datafile} from cache")
+        return chunks
+
+    chunks = database.compile_entries(parser(datafile))
+    try:
+        write_cache(datafile, chunks)
+    except Exception as e:
+        log.warning(f"Unable to cache {datafile}: {e}")
+
+    return chunks
+
+def get_size(datafile):
+    if isinstance(datafile, ArchivedDatasheet):
+        return datafile.size
+    try:
+        return stat(datafile).st_size
+    except OSError:
+        return 0
+
+def load_datasheets(datafiles:list, jobs:int = 1):
+    '''Runs load_datasheet on each of provided datasheets (paths or
+    ArchivedDatasheet, as returned by list_datasheets). If jobs is more than
+    1 - does that in parallel, with pool of processes. Largest datasheets are
+    scheduled first, so these wont end up processed last while other workers
+    are idle. Yields (datafile, chunks, error) tuples as soon as each datasheet
+    has been loaded, where error is None if loading has succeed'''
+    datafiles = sorted(datafiles, key=get_size, reverse=True)
+
+    def count_loaded(chunks):
+        metrics.METRICS.count('load_datasheets', 'datasheets')
+        metrics.METRICS.count('load_datasheets', 'entries',
+                              sum(len(rows) for datasheet, rows in chunks))
+
+    if jobs <= 1:
+        for datafile in datafiles:
+            try:
+                chunks = load_datasheet(datafile)
+            except Exception as e:
+                yield datafile, None, e
+            else:
+                count_loaded(chunks)
+                yield datafile, chunks, None
+        return
+
+    log.debug(f"Loading datasheets with {jobs} workers")
+    with file_processing.get_executor(jobs, 'process') as pool:
+        futures = {pool.submit(load_datasheet, datafile): datafile
+                   for datafile in datafiles}
+        for future in as_completed(futures):
+            datafile = futures[future]
+            try:
+                chunks = future.result()
+            except Exception as e:
+                yield datafile, None, e
+            else:
+                count_loaded(chunks)
+                yield datafile, chunks, None
+
+def remove_cache(datafile):
+    '''Removes cache of provided datasheet, if there is any'''
+    for extension in ('pickle', 'summary'):
+        try:
+            remove(cache_path(datafile, extension))
+        except FileNotFoundError:
+            pass
+        else:
+            log.debug(f"Removed cached {extension} of {datafile}")
@@ -17,146 +17,658 @@
 # This module contains functions related to working with files
 
 import logging
-from zipfile import ZipFile, is_zipfile
-from py7zr import SevenZipFile, is_7zfile
-from os import listdir, makedirs
-from os.path import isfile, isdir, join, basename, dirname
-from romman import hashcheck
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from zipfile import ZipFile, BadZipFile, is_zipfile
+from gzip import GzipFile
+from contextlib import ExitStack
+from fnmatch import fnmatch
+from threading import Lock
+from os import scandir, makedirs, stat, fstat, sep, remove, replace
+from os.path import isfile, join, basename, dirname
+from romman import hashcheck, pipeline, metrics, io_scheduler
 
 log = logging.getLogger(__name__)
 
-def get_files(pathtodir:str):
-    '''Returns list of files in directory'''
-    files = []
-    #this check is useless in loop below, but allows to use this function to
-    #verify every item passed by user
-    #maybe I should move it to separate function, but for now I wont bother
+def matches_patterns(path:str, name:str, patterns:list):
+    '''Returns True if file's name (or whole path, for patterns containing path
+    separators) matches any of provided glob patterns'''
+    for pattern in patterns:
+        if fnmatch(path if sep in pattern else name, pattern):
+            return True
+    return False
+
+def scan_directory(pathtodir:str, include:list, exclude:list, follow_symlinks:bool,
+                   visited:set, lock):
+    '''Yields ("file", path) and ("dir", path) tuples for content of provided
+    directory, using cached types of its entries to avoid extra stat calls'''
+    with scandir(pathtodir) as directory_content:
+        for entry in directory_content:
+            if exclude and matches_patterns(entry.path, entry.name, exclude):
+                continue
+            try:
+                is_dir = entry.is_dir(follow_symlinks=follow_symlinks)
+            except OSError:
+                is_dir = False
+
+            if not is_dir:
+                #assuming that everything that isnt directory is file
+                if include and not matches_patterns(entry.path, entry.name, include):
+                    continue
+                yield 'file', entry.path
+                continue
+
+            #symlinks may lead to directory we are already in (causing endless
+            #loop) or to one we will reach anyway, thus recording every directory
+            try:
+                st = entry.stat(follow_symlinks=follow_symlinks)
+            except OSError as e:
+                log.warning(f"Unable to access {entry.path}: {e}. Skipping")
+                continue
+            with lock:
+                if (st.st_dev, st.st_ino) in visited:
+                    log.debug("%s leads to visited directory, skipping", entry.path)
+                    continue
+                visited.add((st.st_dev, st.st_ino))
+            yield 'dir', entry.path
+
+def walk_tree(pathtodir:str, include:list, exclude:list, follow_symlinks:bool,
+              visited:set, lock):
+    '''Yields paths of all files inside provided directory and its subdirectories'''
+    stack = [pathtodir]
+    while stack:
+        current = stack.pop()
+        try:
+            for kind, path in scan_directory(current, include, exclude,
+                                             follow_symlinks, visited, lock):
+                if kind == 'file':
+                    yield path
+                else:
+                    stack.append(path)
+        except OSError as e:
+            if current == pathtodir:
+                raise
+            log.warning(f"Unable to scan {current}: {e}. Skipping")
+
+def walk_files(pathtodir:str, include:list = None, exclude:list = None,
+               follow_symlinks:bool = True, threads:int = 1):
+    '''Yields paths of files in directory and all its subdirectories, as soon as
+    these are found. If include/exclude glob patterns have been provided - only
+    yields files matching include and skips files and directories matching
+    exclude. If threads is more than 1 - top-level subdirectories are walked in
+    parallel, to hide latency of network filesystems'''
+    #this check allows to use this function to verify every item passed by user
     if isfile(pathtodir):
-        log.debug(f"{pathtodir} itself is a file, returning")
-        files.append(pathtodir)
-        return files
-
-    log.debug(f"Attempting to parse directory {pathtodir}")
-    directory_content = listdir(pathtodir)
-    log.debug(f"Uncategorized content inside is: {directory_content}")
-
-    for item in directory_content:
-        log.debug(f"Processing {item}")
-        itempath = join(pathtodir, item)
-        if isdir(itempath):
-            log.debug(f"{itempath} leads to directory, processing its content")
-            #looping over this very function for all subdirectories
-            files += get_files(itempath)
+        log.debug("%s itself is a file, returning", pathtodir)
+        yield pathtodir
+        return
+
+    log.debug("Attempting to parse directory %s", pathtodir)
+    visited = set()
+    lock = Lock()
+    try:
+        st = stat(pathtodir)
+    except OSError:
+        pass
+    else:
+        visited.add((st.st_dev, st.st_ino))
+
+    if threads <= 1:
+        yield from walk_tree(pathtodir, include, exclude, follow_symlinks, visited, lock)
+        return
+
+    subdirectories = []
+    for kind, path in scan_directory(pathtodir, include, exclude, follow_symlinks,
+                                     visited, lock):
+        if kind == 'file':
+            yield path
         else:
-            #assuming that everything that isnt directory is file
-            log.debug(f"{itempath} leads to file, adding to list")
-            files.append(itempath)
+            subdirectories.append(path)
+
+    def walk_subdirectories(paths):
+        for path in paths:
+            try:
+                yield from walk_tree(path, include, exclude, follow_symlinks,
+                                     visited, lock)
+            except OSError as e:
+                log.warning(f"Unable to scan {path}: {e}. Skipping")
+
+    if not subdirectories:
+        return
+    #spreading subtrees between threads, all feeding the same queue
+    workers = min(threads, len(subdirectories))
+    chunks = [subdirectories[i::workers] for i in range(workers)]
+    yield from pipeline.merged([walk_subdirectories(chunk) for chunk in chunks])
+
+def get_files(pathtodir:str, include:list = None, exclude:list = None):
+    '''Returns list of files in directory'''
+    return list(walk_files(pathtodir, include, exclude))
+
+#digests calculated for archived files in deep mode, in addition to requested ones
+DEEP_ARCHIVES_DIGESTS = ('crc', 'md5', 'sha1')
+
+#first bytes of each file of these formats
+ZIP_SIGNATURES = (b"PK\x03\x04", b"PK\x05\x06")
+SEVENZIP_SIGNATURE = b"7z\xbc\xaf\x27\x1c"
+#magic bytes followed by compression method, which is always deflate
+GZIP_SIGNATURE = b"\x1f\x8b\x08"
+GZIP_FLAG_EXTRA = 4
+GZIP_FLAG_NAME = 8
+#flags that must never be set in valid gzip header
+GZIP_FLAGS_RESERVED = 0xe0
+#gzip's trailer only stores size of uncompressed data modulo 4GB. Deflate cant
+#compress data better than 1032:1, thus for gzip files smaller than that limit
+#divided by this ratio - its their actual size
+GZIP_SIZE_MODULO = 2 ** 32
+DEFLATE_MAX_RATIO = 1032
+
+def is_gzip_header(header:bytes):
+    '''Returns True if provided first bytes of file look like valid gzip header.
+    Two bytes of magic are way too easy to hit by chance, thus flags are checked
+    too'''
+    return (header[:len(GZIP_SIGNATURE)] == GZIP_SIGNATURE
+            and len(header) > 3 and not header[3] & GZIP_FLAGS_RESERVED)
 
-    log.debug(f"Got following files in total: {files}")
-    return files
+def get_deep_digests(digests:tuple):
+    return DEEP_ARCHIVES_DIGESTS + tuple(d for d in digests if d not in DEEP_ARCHIVES_DIGESTS)
 
-def get_zip_info(pathtofile:str):
-    '''Returns list with zip's internal files info: name, crc, path, inner filepaths'''
-    log.debug(f"Attempting to parse zip archive: {pathtofile}")
+def apply_content_hashsums(data:dict, hashsums:dict):
+    '''Replaces crc of archived file (as stated by archive's headers) with hash
+    sums of its actual content. If these differ - marks it as mismatch'''
+    data['header_crc'] = data['crc']
+    data.update(hashsums)
+    data['crc_mismatch'] = int(data['header_crc'], 16) != int(data['crc'], 16)
+    if data['crc_mismatch']:
+        log.warning(f"Content of '{join(data['location'], data['path'])}' doesnt "
+                    f"match its header: crc is {data['crc']}, while header says "
+                    f"{data['header_crc']}")
+
+def get_zip_info(pathtofile:str, deep:bool = False, digests:tuple = ('crc',),
+                 fileobj = None):
+    '''Returns list with zip's internal files info: name, crc, path, inner filepaths.
+    If deep is set - also streams each file through hashing engine, to calculate
+    hash sums of its actual content (see get_deep_digests), instead of trusting
+    crc from archive's headers. If fileobj has been provided - archive is read
+    from it, instead of opening pathtofile again'''
+    log.debug("Attempting to parse zip archive: %s", pathtofile)
 
     datalist = []
-    with ZipFile(pathtofile, 'r') as zf:
+    with ZipFile(fileobj or pathtofile, 'r') as zf:
         for f in zf.infolist():
             raw_crc = f.CRC
             internal_path = f.filename
             if raw_crc == 0:
-                log.debug(f'{internal_path} is directory or empty, skipping')
+                log.debug('%s is directory or empty, skipping', internal_path)
                 continue
             else:
                 data = {}
                 #this is necessary coz file may be in subdirectory
                 data['name'] = basename(internal_path)
                 data['crc'] = f"{raw_crc:x}"
+                data['size'] = f.file_size
                 data['path'] = internal_path
                 #unlike normal files - this one is located inside archive, so its kinda logical
                 data['location'] = pathtofile
                 data['is_archive'] = 'zip'
 
-                log.debug(f"Got following data: {data}")
+                if deep:
+                    with zf.open(f) as member:
+                        #zipfile throws exception on crc mismatch at the very end
+                        #of file. We compare crc ourselves, so disabling this check
+                        member._expected_crc = None
+                        hashsums = hashcheck.hash_stream(member, get_deep_digests(digests))
+                    apply_content_hashsums(data, hashsums)
+
+                log.debug("Got following data: %s", data)
                 datalist.append(data)
 
-    log.debug(f"Successfully fetched data from {pathtofile}, returning")
+    log.debug("Successfully fetched data from %s, returning", pathtofile)
     return datalist
 
-def get_7z_info(pathtofile:str):
-    '''Returns list with 7z's internal files info: name, crc, path, inner filepaths'''
-    log.debug(f"Attempting to parse 7z archive: {pathtofile}")
+def get_7z_info(pathtofile:str, deep:bool = False, digests:tuple = ('crc',),
+                fileobj = None):
+    '''Returns list with 7z's internal files info: name, crc, path, inner filepaths.
+    For deep and fileobj, see get_zip_info. Solid blocks are decompressed only
+    once, with all files inside hashed along the way'''
+    log.debug("Attempting to parse 7z archive: %s", pathtofile)
+    #py7zr and its compression backends take a while to import, thus these are
+    #only imported once some 7z archive has actually been seen
+    from py7zr import SevenZipFile
+    from romman import sevenzip
 
     datalist = []
-    with SevenZipFile(pathtofile, 'r') as sevenzf:
+    with SevenZipFile(fileobj or pathtofile, 'r') as sevenzf:
         for f in sevenzf.files:
             raw_crc = f.crc32
             internal_path = f.filename
-            if raw_crc == 0:
-                log.debug(f'{internal_path} is directory or empty, skipping')
+            if not raw_crc:
+                log.debug('%s is directory or empty, skipping', internal_path)
                 continue
             else:
                 data = {}
                 #this is necessary coz file may be in subdirectory
                 data['name'] = basename(internal_path)
                 data['crc'] = f"{raw_crc:x}"
+                data['size'] = f.uncompressed
                 data['path'] = internal_path
                 #unlike normal files - this one is located inside archive, so its kinda logical
                 data['location'] = pathtofile
                 data['is_archive'] = '7z'
 
-                log.debug(f"Got following data: {data}")
+                log.debug("Got following data: %s", data)
                 datalist.append(data)
 
-    log.debug(f"Successfully fetched data from {pathtofile}, returning")
+        if deep and datalist:
+            #extracting everything at once, coz files of solid archive can only be
+            #decompressed together anyway
+            factory = sevenzip.HashingFactory(get_deep_digests(digests))
+            #crc from headers has already been saved into datalist
+            sevenzip.disable_crc_checks(sevenzf.files)
+            sevenzf.extract(targets=[data['path'] for data in datalist], factory=factory)
+            for data in datalist:
+                apply_content_hashsums(data, factory.writers[data['path']].hexdigests())
+
+    log.debug("Successfully fetched data from %s, returning", pathtofile)
     return datalist
 
-def get_file_info(pathtofile:str):
-    '''Returns info about normal file: name, crc, path, name of directory'''
-    log.debug(f"Attempting to fetch info from {pathtofile}")
+def read_gzip_name(f):
+    '''Returns original name of file, stored in header of provided gzip file, or
+    None if there is none. File is read from its current position'''
+    header = f.read(10)
+    flags = header[3]
+    if flags & GZIP_FLAG_EXTRA:
+        extra_size = int.from_bytes(f.read(2), 'little')
+        f.read(extra_size)
+    if not flags & GZIP_FLAG_NAME:
+        return None
+
+    name = bytearray()
+    while True:
+        char = f.read(1)
+        if not char or char == b'\0':
+            break
+        name += char
+    return name.decode('latin-1')
+
+def get_gzip_info(pathtofile:str, deep:bool = False, digests:tuple = ('crc',),
+                  fileobj = None):
+    '''Returns list with info about file compressed with gzip: its original name
+    (or name of archive without .gz), crc and size, as stated by gzip's trailer.
+    Size is None if it cant be told from trailer (see GZIP_SIZE_MODULO), unless
+    deep is set. For deep and fileobj, see get_zip_info'''
+    log.debug("Attempting to parse gzip archive: %s", pathtofile)
+
+    with ExitStack() as stack:
+        f = fileobj or stack.enter_context(open(pathtofile, 'rb'))
+        f.seek(0)
+        name = read_gzip_name(f)
+        if not name:
+            name = basename(pathtofile)
+            if name.lower().endswith('.gz'):
+                name = name[:-3]
+
+        #trailer of gzip stores crc and size (modulo 4GB) of uncompressed data
+        f.seek(-8, 2)
+        trailer = f.read(8)
+        compressed_size = f.tell()
+        raw_crc = int.from_bytes(trailer[:4], 'little')
+        if not raw_crc:
+            log.debug('%s is empty, skipping', pathtofile)
+            return []
+
+        data = {}
+        data['name'] = basename(name)
+        data['crc'] = f"{raw_crc:x}"
+        data['size'] = None
+        if compressed_size * DEFLATE_MAX_RATIO < GZIP_SIZE_MODULO:
+            data['size'] = int.from_bytes(trailer[4:], 'little')
+        else:
+            log.debug("%s may be larger than 4GB uncompressed, its size is unknown", pathtofile)
+        data['path'] = name
+        data['location'] = pathtofile
+        data['is_archive'] = 'gzip'
+
+        if deep:
+            f.seek(0)
+            with GzipFile(fileobj=f, mode='rb') as member:
+                hashsums = hashcheck.hash_stream(member, get_deep_digests(digests))
+                data['size'] = member.tell()
+            apply_content_hashsums(data, hashsums)
+
+    log.debug("Got following data: %s", data)
+    return [data]
+
+def get_file_info(pathtofile:str, digests:tuple = ('crc',), known_sizes = None,
+                  fileobj = None):
+    '''Returns info about normal file: name, crc (and other requested digests),
+    size, path, name of directory. If set of known_sizes has been provided and
+    file's size isnt part of it - doesnt calculate hash sums at all, since file
+    cant match any datasheet entry. Such file is returned with crc set to None.
+    If fileobj has been provided - file is read from it, instead of opening
+    pathtofile again'''
+    log.debug("Attempting to fetch info from %s", pathtofile)
+    if fileobj is not None:
+        size = fstat(fileobj.fileno()).st_size
+    else:
+        size = stat(pathtofile).st_size
+
+    #empty files are hashed anyway, coz that costs nothing and they are treated
+    #as files without content below
+    if size and known_sizes is not None and size not in known_sizes:
+        log.debug("No datasheet entry has size of %s, wont hash it", pathtofile)
+        data = {}
+        data['name'] = basename(pathtofile)
+        data['crc'] = None
+        data['size'] = size
+        data['path'] = pathtofile
+        data['location'] = dirname(pathtofile)
+        data['is_archive'] = False
+        return [data]
 
     #List is completely unnecessary, but since zip files have these - I kinda have
     #to follow same route
     #I mean - its needed either there or within file processor. For now its there
     datalist = []
 
-    crc = hashcheck.crc32sum(pathtofile)
-    if crc != '0': #its str coz crc32sum always returns str
+    #crc is always necessary, since its used to find matching datasheet entries
+    if 'crc' not in digests:
+        digests = ('crc',) + tuple(digests)
+    reader = None
+    if io_scheduler.DIRECT_IO:
+        reader = io_scheduler.open_direct(pathtofile, hashcheck.DEFAULT_CHUNK_SIZE)
+    if reader is not None:
+        with reader:
+            hashsums = hashcheck.hash_stream(reader, digests)
+    elif fileobj is not None:
+        hashsums = hashcheck.hash_fileobj(fileobj, digests)
+    else:
+        hashsums = hashcheck.hash_file(pathtofile, digests)
+    if hashsums['crc'] != '0': #its str coz hash_file always returns str
         data = {}
         data['name'] = basename(pathtofile)
-        data['crc'] = crc
+        data.update(hashsums)
+        data['size'] = size
         data['path'] = pathtofile
         data['location'] = dirname(pathtofile)
         data['is_archive'] = False
 
-        log.debug(f"Got following data: {data}")
+        log.debug("Got following data: %s", data)
         datalist.append(data)
 
     #yeah, I know. If crc == 0, returning empty list.
     #It will be .extended to other, regardless
-    log.debug(f"Successfully fetched data from {pathtofile}, returning")
+    log.debug("Successfully fetched data from %s, returning", pathtofile)
     return datalist
 
-def file_processor(pathtofile:str):
+RAW_FORMAT = 'raw'
+#name: (signatures, handler, check) of supported file formats, in order of
+#checking. Each signature is tuple of offset and bytes expected at it. Check is
+#optional function, which receives first bytes of file matching some signature and
+#returns False if file isnt of that format after all. Handler receives opened
+#binary file, its path, digests, known_sizes and deep_archives, and returns list
+#of dictionaries, as described in file_processor. Files that dont match any
+#signature (or that handler of their format has failed to parse, see
+#get_format_errors) are handled by handler of RAW_FORMAT
+FORMATS = {}
+#amount of first bytes of file, enough to check all signatures
+SNIFF_SIZE = 0
+
+def register_format(name:str, signatures:list, handler, check = None):
+    '''Adds support of new file format to file_processor (or replaces handler
+    of existing one). See FORMATS for details'''
+    global SNIFF_SIZE
+    FORMATS[name] = (tuple(signatures), handler, check)
+    for offset, signature in signatures:
+        SNIFF_SIZE = max(SNIFF_SIZE, offset + len(signature))
+
+def detect_format(header:bytes):
+    '''Returns name of format, which signature matches provided first bytes of
+    file. If none does - returns RAW_FORMAT'''
+    for name, (signatures, handler, check) in FORMATS.items():
+        for offset, signature in signatures:
+            if header[offset:offset + len(signature)] != signature:
+                continue
+            if check is None or check(header):
+                return name
+    return RAW_FORMAT
+
+def get_format_errors():
+    '''Returns tuple of exceptions, raised by handlers of archives on files that
+    merely start with signature of some archive format'''
+    errors = (BadZipFile, EOFError, OSError)
+    #py7zr is only imported once some 7z archive has been seen
+    py7zr_exceptions = sys.modules.get('py7zr.exceptions')
+    if py7zr_exceptions is not None:
+        errors += (py7zr_exceptions.ArchiveError,)
+    return errors
+
+register_format(RAW_FORMAT, (),
+    lambda f, path, digests, known_sizes, deep: get_file_info(path, digests, known_sizes, f))
+register_format('zip', [(0, signature) for signature in ZIP_SIGNATURES],
+    lambda f, path, digests, known_sizes, deep: get_zip_info(path, deep, digests, f))
+register_format('7z', [(0, SEVENZIP_SIGNATURE)],
+    lambda f, path, digests, known_sizes, deep: get_7z_info(path, deep, digests, f))
+register_format('gzip', [(0, GZIP_SIGNATURE)],
+    lambda f, path, digests, known_sizes, deep: get_gzip_info(path, deep, digests, f),
+    is_gzip_header)
+
+def file_processor(pathtofile:str, digests:tuple = ('crc',), known_sizes = None,
+                   deep_archives:bool = False):
     '''Depending on received file's type - fetches info from it as archive or
     calculates manually. Return list with dictionary containing info about filepath,
     file's name and crc (or, in case its archive - names and crc of all files inside),
-    also if its zip or not'''
-
-    log.debug(f"Determining filetype of {pathtofile}")
-    if is_zipfile(pathtofile):
-        log.debug(f"Seems like {pathtofile} is zip archive, proceeding accordingly")
-        data = get_zip_info(pathtofile)
-    elif is_7zfile(pathtofile):
-        log.debug(f"Seems like {pathtofile} is 7z archive, proceeding accordingly")
-        data = get_7z_info(pathtofile)
-    else:
-        log.debug(f"{pathtofile} doesnt seem to be an archive, treating as file")
-        data = get_file_info(pathtofile)
+    also if its zip or not. Unless deep_archives is set, digests other than crc
+    are only calculated for normal files, since archives only store crc of their
+    content. For known_sizes, see get_file_info, for deep_archives - get_zip_info.
+    File is opened only once: type is determined by its first bytes (see
+    register_format) or, if none match, by zip's end of central directory
+    record, and the same file object is passed to its handler. If handler fails
+    to parse file as archive - its hashed as normal file instead'''
+
+    with open(pathtofile, 'rb') as f:
+        io_scheduler.advise_sequential(f)
+        try:
+            file_format = detect_format(f.read(SNIFF_SIZE))
+            #self-extracting and other prefixed zips dont start with signature,
+            #but still have zip's central directory at the end
+            if file_format == RAW_FORMAT and is_zipfile(f):
+                file_format = 'zip'
+            log.debug("%s seems to be %s file, proceeding accordingly", pathtofile, file_format)
+            f.seek(0)
+            handler = FORMATS[file_format][1]
+            try:
+                data = handler(f, pathtofile, digests, known_sizes, deep_archives)
+            except get_format_errors() as e:
+                if file_format == RAW_FORMAT:
+                    raise
+                #say, rom that just happens to start with PK\x03\x04
+                log.warning("%s looks like %s file, but cant be parsed as one (%s). "
+                            "Verifying it as normal file", pathtofile, file_format, e)
+                f.seek(0)
+                handler = FORMATS[RAW_FORMAT][1]
+                data = handler(f, pathtofile, digests, known_sizes, deep_archives)
+        finally:
+            io_scheduler.drop_cached(f)
 
-    log.debug(f"Successfully gathered info about {pathtofile}, returning")
+    log.debug("Successfully gathered info about %s, returning", pathtofile)
     return data
 
+#set within each worker of process pool, to avoid sending the same (possibly huge)
+#set of known sizes to workers with each task
+_worker_options = {}
+
+def _init_worker(options:dict):
+    global _worker_options
+    _worker_options = options
+
+def _worker_file_processor(pathtofile:str, digests:tuple):
+    return file_processor(pathtofile, digests, **_worker_options)
+
+def get_executor(jobs:int, executor:str = 'process', initializer = None,
+                 initargs:tuple = ()):
+    '''Returns pool of provided type ('process' or 'thread') with provided amount
+    of workers'''
+    if executor == 'thread':
+        return ThreadPoolExecutor(max_workers=jobs, initializer=initializer,
+                                  initargs=initargs)
+    if executor == 'process':
+        #multiprocessing takes a while to import, and is only needed with jobs
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import get_context, get_all_start_methods
+        #our launcher has no __main__ guard, thus spawned workers would re-run it
+        #forking avoids that, on platforms where its available
+        context = None
+        if 'fork' in get_all_start_methods():
+            context = get_context('fork')
+        return ProcessPoolExecutor(max_workers=jobs, mp_context=context,
+                                   initializer=initializer, initargs=initargs)
+    raise ValueError(f"Unknown executor type: {executor}")
+
+def process_files(paths:list, digests:tuple = ('crc',), jobs:int = 1,
+                  executor:str = 'process', cache = None, rehash:bool = False,
+                  known_sizes = None, max_pending:int = None,
+                  deep_archives:bool = False, order:str = None,
+                  max_bytes_in_flight:int = None):
+    '''Runs file_processor on each of provided paths. If jobs is more than 1 - does
+    that in parallel, with pool of provided type ('process' or 'thread').
+    If hash_cache.HashCache has been provided - files that didnt change since
+    they were cached wont be processed again (unless rehash is set), and results
+    of processed files will be saved into it. For known_sizes, see get_file_info,
+    for deep_archives - get_zip_info.
+    Paths are consumed lazily, with no more than max_pending (by default - twice
+    the amount of jobs) files being processed at once. If max_bytes_in_flight
+    has been provided - also no more than that many bytes (unless single file is
+    larger). If order has been provided - paths are processed in order of their
+    location on disk (see io_scheduler.ordered).
+    Yields (path, data, error) tuples as soon as each file has been processed,
+    where error is None if file_processor has succeed'''
+    #stats are taken before hashing, so file changed in process wont be cached
+    stats = {}
+    options = {'known_sizes': known_sizes, 'deep_archives': deep_archives}
+    #results of deep archive checks are cached under their own tag, coz these
+    #cant be replaced with results of normal ones
+    cache_tags = tuple(digests)
+    if deep_archives:
+        cache_tags += ('deep_archives',)
+
+    def count_hashed(data):
+        metrics.METRICS.count('hash', 'files')
+        hashed_bytes = 0
+        for item in data:
+            if item['crc'] is None:
+                metrics.METRICS.count('hash', 'skipped_files')
+            #content of archives is only read when deep_archives is set
+            elif deep_archives or not item['is_archive']:
+                hashed_bytes += item.get('size') or 0
+        metrics.METRICS.count('hash', 'bytes', hashed_bytes)
+
+    def get_stats():
+        if order:
+            yield from io_scheduler.ordered(paths, order)
+        else:
+            for path in paths:
+                yield path, None
+
+    def get_uncached():
+        for path, st in get_stats():
+            if cache is None and not max_bytes_in_flight:
+                yield path, None, None
+                continue
+            try:
+                st = st or stat(path)
+            except Exception as e:
+                yield path, None, e
+                continue
+            stats[path] = st
+            if cache is None:
+                yield path, None, None
+                continue
+            if not rehash:
+                data = cache.get(path, st, cache_tags)
+                if data is not None:
+                    log.debug("%s didnt change since last run, using cache", path)
+                    metrics.METRICS.count('hash', 'cached_files')
+                    stats.pop(path)
+                    yield path, data, None
+                    continue
+            yield path, None, None
+
+    def store(path, data):
+        count_hashed(data)
+        st = stats.pop(path, None)
+        if cache is None:
+            return
+        #files skipped due to their size wont be cached, coz set of known
+        #sizes may be different on next run
+        if any(item['crc'] is None for item in data):
+            return
+        cache.set(path, st, cache_tags, data)
+
+    if jobs <= 1:
+        for path, data, error in get_uncached():
+            if error or data is not None:
+                yield path, data, error
+                continue
+            try:
+                data = file_processor(path, digests, **options)
+            except Exception as e:
+                stats.pop(path, None)
+                yield path, None, e
+            else:
+                store(path, data)
+                yield path, data, None
+        return
+
+    log.debug("Processing files with %s %s workers", jobs, executor)
+    if executor == 'process':
+        pool = get_executor(jobs, executor, _init_worker, (options,))
+        worker = _worker_file_processor
+    else:
+        pool = get_executor(jobs, executor)
+        worker = lambda path, digests: file_processor(path, digests, **options)
+
+    max_pending = max_pending or jobs * 2
+
+    def collect(done):
+        for future in done:
+            path = futures.pop(future)
+            sizes.pop(future)
+            try:
+                data = future.result()
+            except Exception as e:
+                stats.pop(path, None)
+                yield path, None, e
+            else:
+                store(path, data)
+                yield path, data, None
+
+    def is_busy(size):
+        if len(futures) >= max_pending:
+            return True
+        #single file larger than limit is still processed, just on its own
+        return (max_bytes_in_flight and futures
+                and sum(sizes.values()) + size > max_bytes_in_flight)
+
+    with pool:
+        futures = {}
+        #sizes of files being processed
+        sizes = {}
+        for path, data, error in get_uncached():
+            if error or data is not None:
+                yield path, data, error
+                continue
+            st = stats.get(path)
+            size = st.st_size if st else 0
+            #waiting for some files to finish, before queueing more
+            while is_busy(size):
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                yield from collect(done)
+            future = pool.submit(worker, path, digests)
+            futures[future] = path
+            sizes[future] = size
+
+        yield from collect(as_completed(list(futures)))
+
 def save_file(data, filename:str, filedir:str):
     '''Saves provided binary data as filedir/filename'''
     #avoiding the situation when filedir doesnt exist
@@ -168,12 +680,33 @@ def save_file(data, filename:str, filedir:str):
     with open(save_path, 'wb') as f:
         f.write(data)
 
-    log.debug(f"Successfully saved {filename} as {save_path}")
+    log.debug("Successfully saved %s as %s", filename, save_path)
+
+def save_stream(chunks, filename:str, filedir:str):
+    '''Saves provided iterable of binary chunks as filedir/filename, without
+    holding whole data in memory. Data is written into temporary file first,
+    thus previous version of file remains intact if something goes wrong'''
+    makedirs(filedir, exist_ok=True)
+    save_path = join(filedir, filename)
+    temp_path = f"{save_path}.part"
+
+    try:
+        with open(temp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+    except:
+        #not leaving half-written garbage around
+        if isfile(temp_path):
+            remove(temp_path)
+        raise
+    replace(temp_path, save_path)
+
+    log.debug("Successfully saved %s as %s", filename, save_path)
 
 def extract_zip(path_to_zip:str, output_directory:str, extract_dirs:list = None):
     '''Unpacks everything (in case no valid arguments has been provided) or
     content of all selected zip's directories into provided directory'''
-    log.debug(f"Attempting to unpack {path_to_zip} into {output_directory}")
+    log.debug("Attempting to unpack %s into %s", path_to_zip, output_directory)
     makedirs(output_directory, exist_ok=True)
 
     with ZipFile(path_to_zip, 'r') as zf:
@@ -190,4 +723,4 @@ def extract_zip(path_to_zip:str, output_directory:str, extract_dirs:list = None)
 
         zf.extractall(output_directory, files)
 
-    log.debug(f"Successfully extracted {path_to_zip} into {output_directory}")
+    log.debug("Successfully extracted %s into %s", path_to_zip, output_directory)
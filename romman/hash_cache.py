@@ -0,0 +1,153 @@
+## Romman - utility to compare your console ROMs with accuracy-focused datasheets
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module contains cache of already calculated hash sums of ROM files
+
+import logging
+import pickle
+from tempfile import mkstemp
+from os import makedirs, replace, remove, fdopen
+from os.path import join, abspath, exists, dirname, basename
+from romman import configuration
+
+log = logging.getLogger(__name__)
+
+CACHE_DIRECTORY = configuration.CACHE_DIRECTORY
+HASH_CACHE_PATH = join(CACHE_DIRECTORY, 'hashes.pickle')
+#bump this each time format of cached data changes, to make old caches invalid
+CACHE_VERSION = 3
+
+def strip_item(item:dict):
+    '''Returns copy of file_processor's result without data that depends on path
+    file has been reached by (its location and, unless its part of archive - its
+    path and name). These are restored from path of the current run on lookup'''
+    if item['is_archive']:
+        fields = ('location',)
+    else:
+        fields = ('location', 'path', 'name')
+    return {key: value for key, value in item.items() if key not in fields}
+
+def restore_item(item:dict, pathtofile:str):
+    '''Returns copy of item, stripped by strip_item, with data of provided path'''
+    item = dict(item)
+    if item['is_archive']:
+        item['location'] = pathtofile
+    else:
+        #the same way as file_processing.get_file_info does it
+        item['name'] = basename(pathtofile)
+        item['path'] = pathtofile
+        item['location'] = dirname(pathtofile)
+    return item
+
+def file_key(st):
+    '''Returns tuple that identifies current state of file with provided stat.
+    If file has been modified or replaced - key will change'''
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+class HashCache:
+    '''Storage of file_processor results, keyed by file's path, size, mtime and
+    inode. Loaded and saved in bulk, to avoid touching disk for each file'''
+    def __init__(self, path:str = HASH_CACHE_PATH):
+        self.path = path
+        self.entries = {}
+        self.changed = False
+
+    def load(self):
+        '''Loads all cached entries from disk'''
+        try:
+            with open(self.path, 'rb') as f:
+                version, entries = pickle.load(f)
+        except FileNotFoundError:
+            log.debug(f"{self.path} doesnt exist yet")
+            return
+        except Exception as e:
+            log.warning(f"Hash cache {self.path} seems to be damaged: {e}. Ignoring")
+            return
+
+        if version != CACHE_VERSION:
+            log.debug(f"{self.path} has outdated format, ignoring")
+            return
+
+        self.entries = entries
+        log.debug(f"Loaded {len(self.entries)} cached files from {self.path}")
+
+    def flush(self):
+        '''Saves all cached entries to disk, if there were any changes'''
+        if not self.changed:
+            return
+
+        directory = dirname(self.path) or '.'
+        makedirs(directory, exist_ok=True)
+        #writing into temporary file first, to never leave half-written cache
+        #around. Its unique, coz daemon and cli may flush the same cache at once
+        fd, temp_path = mkstemp(dir=directory, prefix=f".{basename(self.path)}.",
+                                suffix='.tmp')
+        try:
+            with fdopen(fd, 'wb') as f:
+                pickle.dump((CACHE_VERSION, self.entries), f, pickle.HIGHEST_PROTOCOL)
+            replace(temp_path, self.path)
+        except BaseException:
+            remove(temp_path)
+            raise
+        self.changed = False
+        log.debug(f"Saved {len(self.entries)} cached files into {self.path}")
+
+    def get(self, pathtofile:str, st, digests:tuple = ('crc',)):
+        '''Returns cached data of file with provided path and stat, or None if
+        file has been changed since or some of requested digests werent cached'''
+        cached = self.entries.get(abspath(pathtofile))
+        if cached is None:
+            return None
+
+        key, cached_digests, data = cached
+        if key != file_key(st) or not set(digests).issubset(cached_digests):
+            return None
+
+        return [restore_item(item, pathtofile) for item in data]
+
+    def set(self, pathtofile:str, st, digests:tuple, data:list):
+        '''Caches data of file with provided path and stat'''
+        self.entries[abspath(pathtofile)] = (file_key(st), tuple(digests),
+                                             [strip_item(item) for item in data])
+        self.changed = True
+
+    def prune(self, roots:list):
+        '''Removes entries of files that no longer exist, if these are inside of
+        provided directories (or are these paths themselves). Roots that dont
+        exist at all (say, unmounted drive) are ignored, so their files wont be
+        forgotten. Returns amount of removed entries'''
+        paths = set()
+        prefixes = []
+        for root in roots:
+            if not exists(root):
+                continue
+            root = abspath(root)
+            paths.add(root)
+            prefixes.append(join(root, ''))
+        prefixes = tuple(prefixes)
+
+        removed = [path for path in self.entries
+                   if (path in paths or path.startswith(prefixes)) and not exists(path)]
+        for path in removed:
+            del self.entries[path]
+
+        if removed:
+            self.changed = True
+            log.debug(f"Pruned {len(removed)} deleted files from hash cache")
+        return len(removed)
+
+    def __len__(self):
+        return len(self.entries)
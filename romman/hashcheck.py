@@ -16,44 +16,213 @@
 
 # This module contain functions related to calculating hash sums of files
 
-from hashlib import md5
+from hashlib import md5, sha1, sha256
 from zlib import crc32
+from concurrent.futures import ThreadPoolExecutor
+from os import cpu_count
+import os
 import logging
 
 log = logging.getLogger(__name__)
 
-DEFAULT_CHUNK_SIZE = 4096
+#1MB is large enough to keep syscall overhead negligible, yet small enough to
+#not affect ram usage, no matter how large hashed file is
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+MINIMAL_CHUNK_SIZE = 4096
+SUPPORTED_DIGESTS = ('crc', 'md5', 'sha1', 'sha256')
+#files larger than that get their crc32 calculated by multiple threads at once,
+#each processing its own range of file. Set to None to disable
+PARALLEL_CRC_THRESHOLD = 1024 * 1024 * 1024
+#amount of these threads. If multiple files are hashed at once - it should be
+#divided between their workers. Set to 1 to disable
+PARALLEL_CRC_JOBS = cpu_count() or 1
+
+class Crc32:
+    '''Wrapper around zlib's crc32, to make it usable the same way as hashlib's
+    hash objects'''
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = crc32(data, self.value)
+
+    def hexdigest(self):
+        #no leading zeroes, to stay consistent with crc of archived files
+        return f"{self.value & 0xffffffff:x}"
+
+DIGEST_CONSTRUCTORS = {
+    'crc': Crc32,
+    'md5': md5,
+    'sha1': sha1,
+    'sha256': sha256,
+    }
+
+def get_hashers(digests:tuple):
+    '''Returns dictionary with hash objects for each of requested digests'''
+    hashers = {}
+    for digest in digests:
+        if digest not in DIGEST_CONSTRUCTORS:
+            raise ValueError(f"Unsupported digest: {digest}")
+        hashers[digest] = DIGEST_CONSTRUCTORS[digest]()
+    return hashers
+
+def hash_stream(stream, digests:tuple = ('crc',), chunk_size:int = DEFAULT_CHUNK_SIZE):
+    '''Reads provided binary stream till the end, chunk-by-chunk into the same
+    buffer, and feeds each chunk to all requested digests at once.
+    Returns dictionary with hex sums of each digest'''
+    chunk_size = max(chunk_size, MINIMAL_CHUNK_SIZE)
+    hashers = get_hashers(digests)
+    updaters = [hs.update for hs in hashers.values()]
+
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    if hasattr(stream, 'readinto'):
+        while True:
+            size = stream.readinto(buffer)
+            if not size:
+                break
+            chunk = view[:size]
+            for update in updaters:
+                update(chunk)
+    else:
+        #some file-like objects (say, these from archives) cant read into buffer
+        for chunk in iter(lambda: stream.read(chunk_size), b""):
+            for update in updaters:
+                update(chunk)
+    view.release()
+
+    return {name: hs.hexdigest() for name, hs in hashers.items()}
+
+def gf2_matrix_times(matrix:list, vector:int):
+    result = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return result
+
+def gf2_matrix_square(matrix:list):
+    return [gf2_matrix_times(matrix, row) for row in matrix]
+
+def crc32_combine(crc1:int, crc2:int, length2:int):
+    '''Returns crc32 of two concatenated blocks of data, from crc32 of first
+    block, crc32 of second and length of second. Port of zlib's crc32_combine,
+    which isnt exposed by python's zlib module'''
+    if length2 <= 0:
+        return crc1
+
+    #operator for one zero bit
+    odd = [0xedb88320] + [1 << n for n in range(31)]
+    #operator for two zero bits
+    even = gf2_matrix_square(odd)
+    #operator for four zero bits
+    odd = gf2_matrix_square(even)
+
+    #applying len2 zeroes to crc1 (first square will put the operator for one
+    #zero byte, eight zero bits, in even)
+    while True:
+        even = gf2_matrix_square(odd)
+        if length2 & 1:
+            crc1 = gf2_matrix_times(even, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+
+        odd = gf2_matrix_square(even)
+        if length2 & 1:
+            crc1 = gf2_matrix_times(odd, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+
+    return (crc1 ^ crc2) & 0xffffffff
+
+def crc32_range(fd:int, offset:int, length:int, chunk_size:int = DEFAULT_CHUNK_SIZE):
+    '''Returns crc32 of range of already opened file'''
+    value = 0
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    end = offset + length
+    while offset < end:
+        size = min(chunk_size, end - offset)
+        if hasattr(os, 'preadv'):
+            read = os.preadv(fd, [view[:size]], offset)
+            chunk = view[:read]
+        else:
+            chunk = os.pread(fd, size, offset)
+            read = len(chunk)
+        if not read:
+            raise IOError(f"unexpected end of file at {offset}")
+        #zlib releases gil on large chunks, thus threads are running in parallel
+        value = crc32(chunk, value)
+        offset += read
+    view.release()
+    return value
+
+def parallel_crc32(fd:int, size:int, jobs:int = None,
+                   chunk_size:int = DEFAULT_CHUNK_SIZE):
+    '''Calculates crc32 of first size bytes of already opened file by splitting
+    these into ranges, processing each in its own thread and combining results.
+    Returns int with sum of result'''
+    jobs = jobs or PARALLEL_CRC_JOBS
+    range_size = -(-size // jobs) if size else 0
+    ranges = [(offset, min(range_size, size - offset))
+              for offset in range(0, size, range_size or 1)]
+    log.debug("Calculating crc32 of fd %s in %s ranges", fd, len(ranges))
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        partial_sums = list(pool.map(
+                            lambda r: crc32_range(fd, r[0], r[1], chunk_size),
+                            ranges))
+
+    value = 0
+    for (offset, length), partial_sum in zip(ranges, partial_sums):
+        value = crc32_combine(value, partial_sum, length)
+    return value
+
+def parallel_crc32sum(filepath:str, jobs:int = None, chunk_size:int = DEFAULT_CHUNK_SIZE):
+    '''Calculates crc32 of a file with parallel_crc32. Returns str with sum of
+    result, identical to crc32sum'''
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        value = parallel_crc32(fd, os.fstat(fd).st_size, jobs, chunk_size)
+    finally:
+        os.close(fd)
+
+    return f"{value:x}"
+
+def hash_fileobj(f, digests:tuple = ('crc',), chunk_size:int = DEFAULT_CHUNK_SIZE):
+    '''Calculates all requested digests of already opened binary file in one
+    pass, reading it from the very start. Returns dictionary with hex sums of
+    each digest'''
+    log.debug("Calculating %s of %s", digests, getattr(f, 'name', f))
+    #unlike other digests, crc32 of parts can be combined, thus large files may
+    #be split between multiple cores
+    if (tuple(digests) == ('crc',) and PARALLEL_CRC_THRESHOLD is not None
+        and PARALLEL_CRC_JOBS > 1):
+        size = os.fstat(f.fileno()).st_size
+        if size >= PARALLEL_CRC_THRESHOLD:
+            return {'crc': f"{parallel_crc32(f.fileno(), size, chunk_size=chunk_size):x}"}
+
+    f.seek(0)
+    hashsums = hash_stream(f, digests, chunk_size)
+
+    log.debug("Got hash sums: %s", hashsums)
+    return hashsums
+
+def hash_file(filepath:str, digests:tuple = ('crc',), chunk_size:int = DEFAULT_CHUNK_SIZE):
+    '''Calculates all requested digests of a file in one pass.
+    Returns dictionary with hex sums of each digest'''
+    #buffering is disabled, coz we read in large chunks anyway
+    with open(filepath, "rb", buffering=0) as f:
+        return hash_fileobj(f, digests, chunk_size)
 
 def md5sum(filepath:str, chunk_size:int = DEFAULT_CHUNK_SIZE):
     '''Calculates md5 of a file, chunk-by-chunk and returns str with sum of result'''
-    log.debug(f"Processing the file {filepath}")
-    #ensuring that chunk_size is not less than default
-    if chunk_size < DEFAULT_CHUNK_SIZE:
-        chunk_size == DEFAULT_CHUNK_SIZE
-    log.debug(f"Chunk size has been set to {chunk_size}")
-
-    hs = md5()
-    #'b' coz hashsum is calculated by file's binary content
-    with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(chunk_size), b""):
-            #this adds hashes of new chunks to previously calculated ones
-            hs.update(chunk)
-
-    hashsum = hs.hexdigest()
-
-    log.debug(f"Got md5 sum: {hashsum}")
-    return hashsum
-
-def crc32sum(filepath:str):
-    '''Calculates crc32 of a file and returns str with sum of result'''
-    #TODO: add ability to calculate crc by chunks
-    log.debug(f"Processing the file {filepath}")
-    with open(filepath, "rb") as f:
-        data = f.read()
-        hs = crc32(data) & 0xffffffff
-
-    hx = hex(hs)
-    hashsum = hx.replace('0x', '')
-
-    log.debug(f"Got crc32 sum: {hashsum}")
-    return hashsum
+    return hash_file(filepath, ('md5',), chunk_size)['md5']
+
+def crc32sum(filepath:str, chunk_size:int = DEFAULT_CHUNK_SIZE):
+    '''Calculates crc32 of a file, chunk-by-chunk and returns str with sum of result'''
+    return hash_file(filepath, ('crc',), chunk_size)['crc']
@@ -0,0 +1,186 @@
+## Romman - utility to compare your console ROMs with accuracy-focused datasheets
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module contains helpers to schedule reads of files being hashed, so these
+# are read in order of their location on disk and dont flood the page cache
+
+import logging
+import mmap
+import os
+import struct
+from os import stat
+
+#fcntl only exists on unix-like systems
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+#orders files can be read in: by inode number (cheap, as it only requires stat)
+#or by physical location of their first extent on disk (requires to open each
+#file, falls back to inode on filesystems that dont support it, say nfs)
+ORDERS = ('inode', 'extent')
+#amount of paths to sort at once. Paths are yielded lazily, thus whole tree is
+#never held in memory
+DEFAULT_WINDOW = 1024
+
+#drop data of hashed files from page cache, so bulk hashing wont evict
+#everything else from it. Set by cli
+DROP_PAGE_CACHE = True
+#read files being hashed with O_DIRECT, bypassing page cache. Set by cli
+DIRECT_IO = False
+DIRECT_IO_ALIGNMENT = 4096
+
+#see linux/fs.h and linux/fiemap.h
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct('=QQIIII')
+FIEMAP_EXTENT_SIZE = 56
+
+def get_physical_offset(pathtofile:str):
+    '''Returns physical offset of first extent of provided file on its device,
+    or None if filesystem doesnt report it'''
+    if fcntl is None:
+        return None
+    #requesting one extent, starting from the very beginning of file
+    buffer = bytearray(FIEMAP_HEADER.pack(0, 0xffffffffffffffff, 0, 0, 1, 0))
+    buffer += bytes(FIEMAP_EXTENT_SIZE)
+    try:
+        fd = os.open(pathtofile, os.O_RDONLY)
+        try:
+            fcntl.ioctl(fd, FS_IOC_FIEMAP, buffer, True)
+        finally:
+            os.close(fd)
+    except OSError:
+        return None
+
+    mapped_extents = FIEMAP_HEADER.unpack_from(buffer)[3]
+    if not mapped_extents:
+        return None
+    #fe_logical goes first, then fe_physical
+    return struct.unpack_from('=Q', buffer, FIEMAP_HEADER.size + 8)[0]
+
+def get_order_key(pathtofile:str, st, order:str):
+    if st is None:
+        return (-1, 0)
+    if order == 'extent':
+        offset = get_physical_offset(pathtofile)
+        if offset is not None:
+            return (st.st_dev, offset)
+    return (st.st_dev, st.st_ino)
+
+def ordered(paths, order:str = 'inode', window:int = DEFAULT_WINDOW):
+    '''Yields (path, stat) of provided paths, sorted by their location on disk
+    within each window of paths. Stat is None if it couldnt be obtained'''
+    if order not in ORDERS:
+        raise ValueError(f"Unknown order: {order}")
+
+    def sort_window(items):
+        items.sort(key=lambda item: get_order_key(item[0], item[1], order))
+        return items
+
+    items = []
+    for path in paths:
+        try:
+            st = stat(path)
+        except OSError:
+            st = None
+        items.append((path, st))
+        if len(items) >= window:
+            yield from sort_window(items)
+            items = []
+    yield from sort_window(items)
+
+def advise(f, advice:int):
+    '''Calls posix_fadvise on whole provided file, if its available'''
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(f.fileno(), 0, 0, advice)
+    except OSError as e:
+        log.debug("Couldnt advise kernel about %s: %s", getattr(f, 'name', f), e)
+
+def advise_sequential(f):
+    '''Tells kernel that provided file will be read sequentially, so it reads
+    ahead more aggressively'''
+    if hasattr(os, 'POSIX_FADV_SEQUENTIAL'):
+        advise(f, os.POSIX_FADV_SEQUENTIAL)
+
+def drop_cached(f):
+    '''Tells kernel that data of provided file wont be needed anymore, if
+    DROP_PAGE_CACHE is set'''
+    if DROP_PAGE_CACHE and hasattr(os, 'POSIX_FADV_DONTNEED'):
+        advise(f, os.POSIX_FADV_DONTNEED)
+
+class DirectReader:
+    '''Binary file opened with O_DIRECT, which supports readinto (and thus can be
+    passed to hashcheck.hash_stream). Reads are done in large chunks, aligned to
+    DIRECT_IO_ALIGNMENT, into aligned buffer'''
+    def __init__(self, pathtofile:str, chunk_size:int):
+        self.name = pathtofile
+        self.fd = os.open(pathtofile, os.O_RDONLY | os.O_DIRECT)
+        #reads at unaligned offset fail even at the end of file, thus its size
+        #is used to know when to stop
+        self.size = os.fstat(self.fd).st_size
+        self.chunk_size = -(-chunk_size // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT
+        #anonymous mmap is always aligned to page size
+        self.buffer = mmap.mmap(-1, self.chunk_size)
+        self.offset = 0
+
+    def readinto(self, buffer):
+        if self.offset >= self.size:
+            return 0
+        size = min(len(buffer), self.chunk_size)
+        size -= size % DIRECT_IO_ALIGNMENT
+        if not size:
+            raise ValueError(f"buffer is smaller than {DIRECT_IO_ALIGNMENT} bytes")
+        with memoryview(self.buffer) as view:
+            read = os.preadv(self.fd, [view[:size]], self.offset)
+            buffer[:read] = view[:read]
+        self.offset += read
+        return read
+
+    def close(self):
+        os.close(self.fd)
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open_direct(pathtofile:str, chunk_size:int):
+    '''Returns DirectReader of provided file, or None if O_DIRECT isnt supported
+    by platform or filesystem (say, tmpfs)'''
+    if not hasattr(os, 'O_DIRECT') or not hasattr(os, 'preadv'):
+        return None
+    try:
+        reader = DirectReader(pathtofile, chunk_size)
+    except OSError as e:
+        log.debug("Couldnt open %s with O_DIRECT: %s", pathtofile, e)
+        return None
+
+    #some filesystems accept O_DIRECT on open, but fail on read
+    try:
+        reader.readinto(bytearray(DIRECT_IO_ALIGNMENT))
+    except OSError as e:
+        log.debug("Couldnt read %s with O_DIRECT: %s", pathtofile, e)
+        reader.close()
+        return None
+    reader.offset = 0
+    return reader
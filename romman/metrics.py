@@ -0,0 +1,181 @@
+## Romman - utility to compare your console ROMs with accuracy-focused datasheets
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module contains instrumentation, used to find out how long each stage of
+# processing takes
+
+import cProfile
+import json
+import logging
+import sys
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+#resource module only exists on unix-like systems
+try:
+    import resource
+except ImportError:
+    resource = None
+
+log = logging.getLogger(__name__)
+
+#counters, for which rate per second is calculated
+RATE_COUNTERS = ('files', 'entries', 'datasheets')
+
+def get_children_cpu_time():
+    '''Returns cpu time spent by finished child processes (say, workers of
+    process pools), or 0 if it cant be obtained'''
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def get_peak_rss():
+    '''Returns tuple with peak resident memory (in bytes) of current process and
+    of its largest finished child process. Items are None if unknown'''
+    if resource is None:
+        return None, None
+    #linux reports these in kilobytes, macos - in bytes
+    multiplier = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * multiplier,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * multiplier)
+
+class Metrics:
+    '''Collector of wall and cpu time, spent on each named stage of processing,
+    plus arbitrary counters of these stages (files, bytes, entries, etc). Stages
+    may be entered multiple times - their time is summed up. Cpu time is that of
+    whole process (including finished worker processes), thus stages running at
+    the same time (say, walking directories in background while hashing files)
+    share it. Time is only measured if enabled is set, while counters are
+    always updated, since these cost next to nothing'''
+    def __init__(self, enabled:bool = False):
+        self.enabled = enabled
+        self.stages = {}
+        self.lock = Lock()
+        self.started = time.perf_counter()
+
+    def get_stage(self, name:str):
+        return self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+
+    def add_time(self, name:str, wall:float, cpu:float):
+        with self.lock:
+            stage = self.get_stage(name)
+            stage['wall'] += wall
+            stage['cpu'] += cpu
+
+    def count(self, name:str, counter:str, amount:int = 1):
+        '''Adds provided amount to counter of provided stage'''
+        with self.lock:
+            stage = self.get_stage(name)
+            stage[counter] = stage.get(counter, 0) + amount
+
+    @contextmanager
+    def stage(self, name:str):
+        '''Context manager that adds time spent inside it to provided stage'''
+        if not self.enabled:
+            yield
+            return
+
+        wall = time.perf_counter()
+        cpu = time.process_time() + get_children_cpu_time()
+        try:
+            yield
+        finally:
+            self.add_time(name,
+                          time.perf_counter() - wall,
+                          time.process_time() + get_children_cpu_time() - cpu)
+
+    def timed_iter(self, name:str, iterable):
+        '''Yields items of provided iterable, adding time spent waiting for each
+        of them to provided stage. Time spent by consumer isnt counted'''
+        if not self.enabled:
+            yield from iterable
+            return
+
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def as_dict(self):
+        '''Returns dictionary with all stages, their counters and rates, total
+        run time and peak memory usage'''
+        stages = {}
+        with self.lock:
+            for name, stage in self.stages.items():
+                data = dict(stage)
+                wall = data['wall']
+                if wall:
+                    if 'bytes' in data:
+                        data['mb_per_second'] = round(data['bytes'] / wall / (1024 * 1024), 2)
+                    for counter in RATE_COUNTERS:
+                        if counter in data:
+                            data[f'{counter}_per_second'] = round(data[counter] / wall, 2)
+                data['wall'] = round(data['wall'], 6)
+                data['cpu'] = round(data['cpu'], 6)
+                stages[name] = data
+
+        peak_rss, peak_children_rss = get_peak_rss()
+        return {
+            'wall': round(time.perf_counter() - self.started, 6),
+            'peak_rss': peak_rss,
+            'peak_children_rss': peak_children_rss,
+            'stages': stages,
+            }
+
+    def report(self):
+        '''Logs summary of each stage'''
+        data = self.as_dict()
+        for name, stage in data['stages'].items():
+            extra = ", ".join(f"{key}: {value}" for key, value in stage.items()
+                              if key not in ('wall', 'cpu'))
+            log.info(f"Stage '{name}' took {stage['wall']:.3f}s (cpu: "
+                     f"{stage['cpu']:.3f}s){', ' + extra if extra else ''}")
+        if data['peak_rss'] is not None:
+            log.info(f"Total time: {data['wall']:.3f}s, peak memory usage: "
+                     f"{data['peak_rss'] / (1024 * 1024):.1f}MB (largest worker: "
+                     f"{data['peak_children_rss'] / (1024 * 1024):.1f}MB)")
+        else:
+            log.info(f"Total time: {data['wall']:.3f}s")
+
+    def save(self, path:str):
+        '''Saves metrics as json into provided file'''
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=4)
+            f.write('\n')
+        log.debug(f"Saved metrics into {path}")
+
+#metrics of current run, filled by instrumented functions
+METRICS = Metrics()
+
+def start_profiler():
+    '''Returns enabled cProfile.Profile. Only code of current process is
+    profiled, not of its workers'''
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def save_profile(profiler, path:str):
+    '''Stops provided profiler and dumps its stats into provided file (which
+    can be viewed with pstats or snakeviz)'''
+    profiler.disable()
+    profiler.dump_stats(path)
+    log.info(f"Saved profiling data into {path}")
@@ -0,0 +1,87 @@
+## Romman - utility to compare your console ROMs with accuracy-focused datasheets
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module contains helpers to chain processing stages into streaming pipeline
+
+import logging
+from queue import Queue, Full
+from threading import Thread, Event
+
+log = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 256
+
+#marker, sent through queue after the last item
+_DONE = object()
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+def merged(iterables:list, maxsize:int = DEFAULT_QUEUE_SIZE):
+    '''Consumes each of provided iterables in its own background thread and
+    yields their items (in order of arrival) through queue of provided size.
+    Exceptions of iterables are re-raised in consumer'''
+    queue = Queue(maxsize=maxsize)
+    stop = Event()
+
+    def put(item):
+        #checking for stop once in a while, so producer wont hang forever if
+        #consumer has quit early
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+            except Full:
+                continue
+            return True
+        return False
+
+    def producer(iterable):
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(_Failure(e))
+        else:
+            put(_DONE)
+
+    threads = [Thread(target=producer, args=(iterable,), daemon=True)
+               for iterable in iterables]
+    for thread in threads:
+        thread.start()
+
+    try:
+        finished = 0
+        while finished < len(threads):
+            item = queue.get()
+            if item is _DONE:
+                finished += 1
+                continue
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+def buffered(iterable, maxsize:int = DEFAULT_QUEUE_SIZE):
+    '''Consumes provided iterable in background thread and yields its items
+    through queue of provided size. This allows previous stage of pipeline to
+    keep working while next one is busy, without ever holding more than maxsize
+    items in memory. Exceptions of iterable are re-raised in consumer'''
+    return merged([iterable], maxsize)
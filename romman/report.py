@@ -0,0 +1,235 @@
+## Romman - utility to compare your console ROMs with accuracy-focused datasheets
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module contains functions related to reporting results of verification:
+# machine-readable reports, summary counters and renaming of misnamed files
+
+import csv
+import json
+import logging
+from os import rename
+from os.path import join, basename, dirname, exists, samefile
+
+log = logging.getLogger(__name__)
+
+REPORT_FORMATS = ('jsonl', 'csv')
+#statuses of report records
+MATCH = 'match'
+MISS = 'miss'
+ERROR = 'error'
+BAD_NAME = 'bad_name'
+RENAMED = 'renamed'
+RENAME_FAILED = 'rename_failed'
+
+CSV_FIELDS = ('status', 'path', 'name', 'location', 'is_archive', 'crc', 'size',
+              'md5', 'sha1', 'sha256', 'header_crc', 'crc_mismatch', 'entry_name',
+              'game', 'group', 'category', 'new_path', 'error')
+
+def get_report_format(path:str):
+    '''Returns format of report, determined by extension of provided path'''
+    if path.lower().endswith('.csv'):
+        return 'csv'
+    return 'jsonl'
+
+class ReportWriter:
+    '''Writes report records into file as soon as these arrive, one per line
+    (json object or csv row)'''
+    def __init__(self, path:str, report_format:str = None):
+        self.report_format = report_format or get_report_format(path)
+        if self.report_format not in REPORT_FORMATS:
+            raise ValueError(f"Unknown report format: {self.report_format}")
+        self.path = path
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = None
+        if self.report_format == 'csv':
+            self.writer = csv.DictWriter(self.file, CSV_FIELDS, extrasaction='ignore')
+            self.writer.writeheader()
+
+    def write(self, record:dict):
+        if self.writer is not None:
+            self.writer.writerow(record)
+        else:
+            self.file.write(json.dumps(record, ensure_ascii=False))
+            self.file.write('\n')
+
+    def close(self):
+        self.file.close()
+        log.debug(f"Saved report into {self.path}")
+
+def display_name(item:dict):
+    '''Returns path of file from process_files's results, as shown to user'''
+    if item['is_archive']:
+        return join(item['location'], item['path'])
+    return item['path']
+
+def rename_batch(renames:list):
+    '''Renames files according to provided list of (old path, new path) tuples.
+    Renames that would overwrite existing file or move multiple files to the
+    same path are skipped. Files are moved to temporary names first, so chains
+    and swaps of names (A to B while B to A) work. Returns list of (old path,
+    new path, error) tuples, where error is None if renaming has succeed'''
+    results = []
+    targets = {}
+    for old, new in renames:
+        targets.setdefault(new, []).append(old)
+    sources = {old for old, new in renames}
+
+    pending = []
+    for old, new in renames:
+        if len(targets[new]) > 1:
+            results.append((old, new, FileExistsError(
+                f"{len(targets[new])} files should be named {new}")))
+        #target may be the very same file, on case-insensitive filesystems
+        elif exists(new) and new not in sources and not samefile(old, new):
+            results.append((old, new, FileExistsError(f"{new} already exists")))
+        else:
+            pending.append((old, new))
+
+    moved = []
+    for old, new in pending:
+        temp = join(dirname(old), f".{basename(old)}.renaming")
+        try:
+            rename(old, temp)
+        except OSError as e:
+            results.append((old, new, e))
+        else:
+            moved.append((old, temp, new))
+
+    for old, temp, new in moved:
+        try:
+            #rename silently overwrites existing files, thus checking again -
+            #some file that should have been moved away may have failed to
+            if exists(new):
+                raise FileExistsError(f"{new} already exists")
+            rename(temp, new)
+        except OSError as e:
+            try:
+                rename(temp, old)
+            except OSError as restore_error:
+                log.error(f"Couldnt restore '{old}' from '{temp}': {restore_error}")
+            results.append((old, new, e))
+        else:
+            results.append((old, new, None))
+
+    return results
+
+class Reporter:
+    '''Collects results of verification: logs them, writes them into report (if
+    ReportWriter has been provided) and keeps summary counters. Matches and
+    misses are only logged if log_results is set. Files are
+    counted once, no matter how many datasheet entries they match. Misnamed
+    files are renamed in one batch by apply_renames, if allow_rename is set'''
+    def __init__(self, writer:ReportWriter = None, allow_rename:bool = False,
+                 log_results:bool = True):
+        self.writer = writer
+        self.allow_rename = allow_rename
+        self.log_results = log_results
+        self.files = set()
+        self.matched = set()
+        self.bad_names = set()
+        self.errors = 0
+        self.renamed = 0
+        self.failed_renames = 0
+        #old path: new path
+        self.renames = {}
+
+    def write(self, status:str, **record):
+        if self.writer is not None:
+            record['status'] = status
+            self.writer.write(record)
+
+    def add_error(self, path:str, error):
+        '''Reports file that couldnt be processed. Error may be None, if file
+        has no content to verify (say, empty file or archive)'''
+        self.errors += 1
+        if error is None:
+            log.debug("%s has no content to verify", path)
+            error = "no content to verify"
+        else:
+            log.warning(f"Couldnt get hash of {path}: {error}. Skipping")
+        self.write(ERROR, path=path, error=str(error))
+
+    def add_item(self, item:dict, entries:list):
+        '''Reports file from process_files's results and datasheet entries it
+        matches'''
+        name = display_name(item)
+        key = (item['location'], item['path'])
+        self.files.add(key)
+        record = {
+            'path': name,
+            'name': item['name'],
+            'location': item['location'],
+            'is_archive': item['is_archive'] or None,
+            'crc': item['crc'],
+            'size': item.get('size'),
+            'md5': item.get('md5'),
+            'sha1': item.get('sha1'),
+            'sha256': item.get('sha256'),
+            #only set for archived files verified with deep_archives
+            'header_crc': item.get('header_crc'),
+            'crc_mismatch': item.get('crc_mismatch'),
+            }
+        if not entries:
+            if self.log_results:
+                log.info("'%s' doesnt match any datasheet entry", name)
+            self.write(MISS, **record)
+            return
+
+        self.matched.add(key)
+        for entry in entries:
+            if self.log_results:
+                log.info("'%s' matches '%s' in '%s'!", name, entry.name,
+                         join(entry.category, entry.group))
+            self.write(MATCH, entry_name=entry.name, game=entry.game,
+                       group=entry.group, category=entry.category, **record)
+
+        #file may match multiple entries, if any of these has its name - its fine
+        if any(entry.name == item['name'] for entry in entries):
+            return
+        expected = entries[0].name
+        self.bad_names.add(key)
+        self.write(BAD_NAME, entry_name=expected, **record)
+
+        if self.allow_rename and not item['is_archive']:
+            self.renames[item['path']] = join(item['location'], expected)
+        elif self.allow_rename:
+            log.warning(f"'{name}' has incorrect name, but is part of archive - wont rename")
+        else:
+            log.warning(f"'{name}' has incorrect name, should be '{expected}'")
+
+    def apply_renames(self):
+        '''Renames all misnamed files, reported so far'''
+        if not self.renames:
+            return
+        log.info(f"Renaming {len(self.renames)} files with incorrect names")
+        for old, new, error in rename_batch(list(self.renames.items())):
+            if error is None:
+                log.info(f"Renamed '{old}' to '{new}'")
+                self.renamed += 1
+                self.write(RENAMED, path=old, new_path=new)
+            else:
+                log.warning(f"Couldnt rename '{old}' to '{new}': {error}")
+                self.failed_renames += 1
+                self.write(RENAME_FAILED, path=old, new_path=new, error=str(error))
+        self.renames = {}
+
+    @property
+    def misses(self):
+        return len(self.files) - len(self.matched)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
@@ -0,0 +1,70 @@
+## Romman - utility to compare your console ROMs with accuracy-focused datasheets
+## Copyright (c) 2021 moonburnt
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see https://www.gnu.org/licenses/gpl-3.0.txt
+
+# This module contains helpers to hash content of 7z archives with py7zr. Its
+# imported on demand, to not import py7zr unless its needed
+
+from py7zr.io import Py7zIO, WriterFactory
+from romman import hashcheck
+
+class HashingIO(Py7zIO):
+    '''Writer for py7zr, that feeds decompressed data into hashers, instead of
+    storing it anywhere'''
+    def __init__(self, digests:tuple):
+        self.hashers = hashcheck.get_hashers(digests)
+        self.length = 0
+
+    def write(self, s):
+        for hs in self.hashers.values():
+            hs.update(s)
+        self.length += len(s)
+        return len(s)
+
+    def read(self, size = None):
+        return b''
+
+    def seek(self, offset:int, whence:int = 0):
+        return self.length
+
+    def flush(self):
+        pass
+
+    def size(self):
+        return self.length
+
+    def hexdigests(self):
+        return {name: hs.hexdigest() for name, hs in self.hashers.items()}
+
+class HashingFactory(WriterFactory):
+    '''Creates HashingIO for each file of 7z archive being extracted'''
+    def __init__(self, digests:tuple):
+        self.digests = digests
+        self.writers = {}
+
+    def create(self, filename:str):
+        writer = HashingIO(self.digests)
+        self.writers[filename] = writer
+        return writer
+
+def disable_crc_checks(files):
+    '''Makes py7zr skip its own crc checks of provided files (and of solid blocks
+    these are in) on extraction. Otherwise first damaged file aborts extraction
+    of the whole archive, while we compare crc of content with crc from headers
+    by ourselves'''
+    for f in files:
+        f._file_info['digest'] = None
+        if f.folder is not None:
+            f.folder.crc = None